@@ -4,29 +4,8 @@
 
 # PACKAGES
 import sys
-import re
-from numpy import mean
 from Bio import AlignIO
-
-
-# FUNCTIONS
-def calcOverlap(columns):
-    if not columns:
-        return 0
-    # what proportion of columns have nucs in other seqs
-    pcolgaps = []
-    for i in columns:
-        ith = float(alignment[:, i].count("-"))/(len(alignment)-1)
-        pcolgaps.append(ith)
-    # overlap is the mean proportion of columns shared
-    overlap = len(columns) - (len(columns) * mean(pcolgaps))
-    return overlap
-
-
-def calcNgap(sequence):
-    # count the number of gaps
-    gaps = re.subn('-+', '', sequence)[1]
-    return float(gaps)
+from pglt.tools.alignment_tools import alignmentStats
 
 
 # MAIN
@@ -36,11 +15,9 @@ if __name__ == '__main__':
         alignment = AlignIO.read(f, 'fasta')
     alen = alignment.get_alignment_length()
     print('Alignment length [{0}]'.format(alen))
-    for each in alignment:
-        sequence = str(each.seq)
-        columns = [ei for ei, e in enumerate(sequence) if e != "-"]
-        overlap = calcOverlap(columns)
-        ngap = calcNgap(sequence)
+    # same stats as used by checkAlignment in stage 3
+    ngaps, overlaps = alignmentStats(alignment)
+    for each, ngap, overlap in zip(alignment, ngaps, overlaps):
         print('{0}: [{1}] gaps and [{2}] overlap'.
-              format(each.name, ngap, overlap))
+              format(each.name, float(ngap), overlap))
     print('Done.')
@@ -16,6 +16,9 @@ _MAFFT = depsdict['mafft']
 _MAFFTQ = depsdict['mafftq']
 _MAFFTX = depsdict['mafftx']
 _BLASTN = depsdict['blastn']
+# optional tree inference backends
+_RAXMLNG = depsdict.get('raxmlng')
+_FASTTREE = depsdict.get('fasttree')
 del depsdict
 import tools
 import stages
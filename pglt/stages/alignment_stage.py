@@ -8,13 +8,18 @@ pglt Stage 3: Aligning sequences
 # PACAKAGES
 import os
 import re
+import sys
+import random
 import pickle
 import logging
 import shutil
+import multiprocessing
+import Queue
 import numpy
 from Bio import SeqIO
 import pglt.tools.alignment_tools as atools
 from pglt.tools.system_tools import MissingDepError
+from pglt.tools.special_tools import getThreads
 
 
 # FUNCTIONS
@@ -71,35 +76,129 @@ def setUpAligner(gene, genedict, genekeys, seqstore, logger, wd):
     return aligner
 
 
-def runAligner(aligner, naligns, namesdict, gene_dir, logger):
+def calcReplicates(threads, nspp, naligns):
+    """Return number of replicates to run at once and threads for each"""
+    # MAFFT makes poor use of threads for small alignments, so give each
+    #  replicate roughly a thread per 50 species and run as many
+    #  replicates side by side as the remaining threads allow
+    if sys.platform == 'win32':
+        # workers are forked processes
+        return 1, threads
+    threads_per_replicate = max(1, min(threads, nspp // 50))
+    nreplicates = max(1, min(naligns, threads // threads_per_replicate))
+    return nreplicates, threads_per_replicate
+
+
+def runAligner(aligner, naligns, namesdict, gene_dir, logger,
+               nreplicates=1):
     """Run aligner, save alignments as their made"""
-    # run for naligns
-    alignment = None
-    start, end = countNAligns (naligns, gene_dir)
-    each_counter = start
+    start, end = countNAligns(naligns, gene_dir)
+    iterations = range(start, end)
+    if nreplicates > 1 and len(iterations) > 1:
+        each_counter = start + runReplicates(aligner, iterations, namesdict,
+                                             gene_dir, logger, nreplicates)
+    else:
+        each_counter = start + alignIterations(aligner, iterations,
+                                               namesdict, gene_dir, logger)
+    if each_counter < naligns:
+        logger.info(".... too few alignments generated")
+        shutil.rmtree(gene_dir)
+        return 0
+    return each_counter
+
+
+def alignIterations(aligner, iterations, namesdict, gene_dir, logger,
+                    queue=None, key=None):
+    """Run aligner for each iteration, return number of alignments made. \
+If queue, put key and the IDs in each alignment on it."""
+    counter = 0
     try:
-        for i in range(start, end):
+        for i in iterations:
             logger.info(".... iteration [{0}]".format(i))
+            alignment = None
             while not alignment:
                 alignment = aligner.run()
             # log alignment details
             logger.info(".... alignment length [{0}] for [{1}] species".
                         format(alignment.get_alignment_length(),
                                len(alignment)))
+            ids = [record.id for record in alignment]
             namesdict, alignment = writeAlignment(alignment, i, namesdict,
                                                   gene_dir)
-            each_counter += 1
+            if queue is not None:
+                queue.put((key, ids, None))
+            counter += 1
     except atools.TrysError:
         logger.info(".... max trys hit")
     except atools.OutgroupError:
         logger.info(".... outgroup dropped")
     except atools.TooFewSpeciesError:
         logger.info(".... too few species left in sequence pool")
-    if each_counter < naligns:
-        logger.info(".... too few alignments generated")
-        shutil.rmtree(gene_dir)
-        return 0
-    return each_counter
+    return counter
+
+
+def replicateWorker(aligner, iterations, seed, namesdict, gene_dir, logger,
+                    queue, key):
+    """Run aligner in a separate process with its own random stream. Put \
+key and the IDs of each alignment on queue, then key and None once \
+finished, with any error raised."""
+    random.seed(seed)
+    numpy.random.seed(seed)
+    try:
+        alignIterations(aligner, iterations, namesdict, gene_dir, logger,
+                        queue, key)
+    except Exception as error:
+        try:
+            pickle.dumps(error)
+        except Exception:
+            error = RuntimeError(str(error))
+        queue.put((key, None, error))
+        return
+    queue.put((key, None, None))
+
+
+def runReplicates(aligner, iterations, namesdict, gene_dir, logger,
+                  nreplicates):
+    """Run nreplicates aligners at once, each in its own process. Return \
+number of alignments made. Errors in a worker are raised once all workers \
+have finished."""
+    logger.info(".... running [{0}] replicates at once".format(nreplicates))
+    queue = multiprocessing.Queue()
+    running = {}
+    for k in range(nreplicates):
+        # each worker gets every nreplicate-th iteration and a seed
+        seed = random.randint(0, 4294967295)
+        worker = multiprocessing.Process(
+            target=replicateWorker, args=(aligner, iterations[k::nreplicates],
+                                          seed, namesdict, gene_dir, logger,
+                                          queue, k))
+        worker.start()
+        running[k] = worker
+    counter = 0
+    errors = []
+    while running:
+        try:
+            k, ids, error = queue.get(timeout=60)
+        except Queue.Empty:
+            # make sure no worker has died without reporting
+            for k in running.keys():
+                if not running[k].is_alive() and queue.empty():
+                    errors.append(RuntimeError(
+                        'replicate worker [{0}] died with exit code [{1}]'.
+                        format(k, running[k].exitcode)))
+                    running.pop(k).join()
+            continue
+        if ids is None:
+            if error is not None:
+                errors.append(error)
+            running.pop(k).join()
+            continue
+        for txid in ids:
+            namesdict[txid]['alignments'] += 1
+        counter += 1
+    if errors:
+        raise errors[0]
+    return counter
 
 
 def writeAlignment(alignment, i, namesdict, gene_dir):
@@ -107,16 +206,135 @@ def writeAlignment(alignment, i, namesdict, gene_dir):
     # record records in alignment
     for record in alignment:
         namesdict[record.id]['alignments'] += 1
-    # write out
+    # write out to hidden file and rename, so that partially written
+    #  alignments are never read
     align_len = alignment.get_alignment_length()
     output_file = "{0}_nspp{1}_len{2}.faa".format(i, len(alignment), align_len)
     output_path = os.path.join(gene_dir, output_file)
-    with open(output_path, "w") as file:
+    temp_path = os.path.join(gene_dir, '.' + output_file + '.tmp')
+    with open(temp_path, "w") as file:
         count = SeqIO.write(alignment, file, "fasta")
         del count
+    os.rename(temp_path, output_path)
     return namesdict, None
 
 
+def alignGene(gene, seqstore, genedict, genekeys, naligns, namesdict,
+              alignment_dir, threads, logger, wd):
+    """Set up and run aligner for gene, return number of alignments"""
+    logger.info("Aligning gene [{0}] for [{1}] species ....".
+                format(gene, len(seqstore)))
+    # set up dir
+    gene_dir = os.path.join(alignment_dir, gene)
+    if not os.path.isdir(gene_dir):
+        os.mkdir(gene_dir)
+    aligner = setUpAligner(gene, genedict, genekeys, seqstore, logger, wd)
+    # split threads between MAFFT and replicates
+    nreplicates, aligner.threads = calcReplicates(threads, len(seqstore),
+                                                  naligns)
+    seqstore.threads = aligner.threads
+    return runAligner(aligner, naligns, namesdict, gene_dir, logger,
+                      nreplicates)
+
+
+def calcGeneWorkers(threads, ngenes):
+    """Return number of genes to align at once"""
+    if sys.platform == 'win32':
+        # workers are forked processes
+        return 1
+    return max(1, min(threads, ngenes))
+
+
+def geneWorker(gene, seqstore, genedict, genekeys, naligns, names,
+               alignment_dir, threads, logger, wd, queue):
+    """Align gene in a separate process logging to its own file. Put \
+gene, number of alignments and alignment counts per name on queue."""
+    # gene log is written to wd and added to the stage log once all
+    #  genes have finished
+    gene_logger = logging.getLogger('{0}_{1}'.format(logger.name, gene))
+    gene_logger.setLevel(logger.getEffectiveLevel())
+    loghandler = logging.FileHandler(geneLogPath(gene, wd), 'w')
+    loghandler.setFormatter(logging.Formatter('%(message)s'))
+    gene_logger.addHandler(loghandler)
+    gene_logger.propagate = False
+    seqstore.logger = gene_logger
+    # count alignments for this gene only
+    namesdict = dict([(name, {'alignments': 0}) for name in names])
+    try:
+        counter = alignGene(gene, seqstore, genedict, genekeys, naligns,
+                            namesdict, alignment_dir, threads, gene_logger,
+                            wd)
+    except Exception as error:
+        gene_logger.error(str(error))
+        queue.put((gene, None, str(error)))
+        raise
+    finally:
+        loghandler.close()
+    counts = dict([(name, namesdict[name]['alignments']) for name in names if
+                   namesdict[name]['alignments'] > 0])
+    queue.put((gene, counter, counts))
+
+
+def geneLogPath(gene, wd):
+    """Return path to a gene's log file"""
+    return os.path.join(wd, '{0}_alignment_log.txt'.format(gene))
+
+
+def runGenes(genestore, genedict, genekeys, naligns, namesdict,
+             alignment_dir, threads, ngeneworkers, logger, wd):
+    """Align ngeneworkers genes at once, each in its own process. Merge \
+alignment counts into namesdict and gene logs into logger in gene order. \
+Return number of alignments made."""
+    logger.info(".... aligning [{0}] genes at once".format(ngeneworkers))
+    gene_threads = max(1, threads // ngeneworkers)
+    queue = multiprocessing.Queue()
+    waiting = list(genestore)
+    running = {}
+    results = {}
+    while waiting or running:
+        # start as many workers as allowed, then wait for one to finish
+        while waiting and len(running) < ngeneworkers:
+            gene, seqstore = waiting.pop(0)
+            worker = multiprocessing.Process(
+                target=geneWorker, args=(gene, seqstore, genedict, genekeys,
+                                         naligns, namesdict.keys(),
+                                         alignment_dir, gene_threads, logger,
+                                         wd, queue))
+            worker.start()
+            running[gene] = worker
+        try:
+            gene, counter, counts = queue.get(timeout=60)
+        except Queue.Empty:
+            # make sure no worker has died without reporting
+            for gene in running.keys():
+                if not running[gene].is_alive() and queue.empty():
+                    results[gene] = (None, 'gene worker for [{0}] died'.
+                                     format(gene))
+                    running.pop(gene).join()
+            continue
+        results[gene] = (counter, counts)
+        running.pop(gene).join()
+    # merge deterministically in gene order
+    all_counter = 0
+    errors = []
+    for gene, _ in genestore:
+        if os.path.isfile(geneLogPath(gene, wd)):
+            with open(geneLogPath(gene, wd), 'r') as file:
+                for line in file:
+                    logger.info(line.rstrip('\n'))
+            os.remove(geneLogPath(gene, wd))
+        counter, counts = results[gene]
+        if counter is None:
+            errors.append(counts)
+            continue
+        for name in sorted(counts.keys()):
+            namesdict[name]['alignments'] += counts[name]
+        all_counter += counter
+    if errors:
+        raise RuntimeError(errors[0])
+    return all_counter
+
+
 # RUN
 def run(wd=os.getcwd(), logger=logging.getLogger('')):
     # PRINT STAGE
@@ -145,6 +363,7 @@ def run(wd=os.getcwd(), logger=logging.getLogger('')):
 
     # PARAMETERS
     naligns = int(paradict["naligns"])
+    threads = getThreads(wd=temp_dir)
     all_counter = 0
 
     # READ IN SEQUENCES
@@ -154,18 +373,17 @@ def run(wd=os.getcwd(), logger=logging.getLogger('')):
 
     # RUN ALIGNMENTS
     logger.info("Running alignments ....")
-    # loop through genes
-    for gene, seqstore in genestore:
-        logger.info("Aligning gene [{0}] for [{1}] species ....".
-                    format(gene, len(seqstore)))
-        # set up dir
-        gene_dir = os.path.join(alignment_dir, gene)
-        if not os.path.isdir(gene_dir):
-            os.mkdir(gene_dir)
-        aligner = setUpAligner(gene, genedict, genekeys, seqstore, logger,
-                               temp_dir)
-        all_counter += runAligner(aligner, naligns, namesdict, gene_dir,
-                                  logger)
+    ngeneworkers = calcGeneWorkers(threads, len(genestore))
+    if ngeneworkers > 1:
+        all_counter += runGenes(genestore, genedict, genekeys, naligns,
+                                namesdict, alignment_dir, threads,
+                                ngeneworkers, logger, temp_dir)
+    else:
+        # loop through genes
+        for gene, seqstore in genestore:
+            all_counter += alignGene(gene, seqstore, genedict, genekeys,
+                                     naligns, namesdict, alignment_dir,
+                                     threads, logger, temp_dir)
 
     # CALC STATS
     # the number of alignments per name in namesdict
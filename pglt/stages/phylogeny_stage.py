@@ -9,10 +9,11 @@ pglt Stage 4: Phylogeny generation
 import os
 import re
 import pickle
+import shutil
 import logging
-from Bio import Phylo
 import pglt.tools.phylogeny_tools as ptools
 from pglt.tools.system_tools import MissingDepError
+from pglt.tools.special_tools import getThreads
 
 
 # RUN
@@ -28,10 +29,6 @@ def run(wd=os.getcwd(), logger=logging.getLogger('')):
                                          'distribution_unconstrained.tre')
     temp_dir = os.path.join(wd, 'tempfiles')
 
-    # CHECK DEPS
-    if not ptools.raxml:
-        raise MissingDepError('raxml')
-
     # INPUT
     with open(os.path.join(temp_dir, "paradict.p"), "rb") as file:
         paradict = pickle.load(file)
@@ -45,36 +42,87 @@ def run(wd=os.getcwd(), logger=logging.getLogger('')):
     maxtrys = int(paradict["maxtrys"])
     rttstat = float(paradict["rttstat"])
     constraint = int(paradict["constraint"])
+    raxml_threads = paradict.get("raxml_threads", "0")
+    backend = ptools.getBackend(paradict.get("backend", "raxml"))
+    asdsf = float(paradict.get("asdsf", 0))
+    minphylos = int(paradict.get("minphylos", 20))
+    prescreen = float(paradict.get("prescreen", 0))
+    njstarts = float(paradict.get("njstarts", 0))
+    raxml_timeout = float(paradict.get("raxml_timeout", 0))
+    batch = int(paradict.get("batch", 1))
     ptools.logger = logger
 
+    # CHECK DEPS
+    if not backend.available:
+        raise MissingDepError(backend.dep)
+    if constraint != 1 and not backend.constrained:
+        logger.warning('Backend [{0}] cannot use the constraint, generating \
+unconstrained phylogenies only'.format(backend.name))
+        constraint = 1
+    if batch > 1 and not backend.batches:
+        logger.warning('Backend [{0}] cannot run searches together, \
+searching one tree per draw'.format(backend.name))
+        batch = 1
+
     # READ ALIGMENTS
     clusters = sorted(os.listdir(alignment_dir))
     clusters = [e for e in clusters if not re.search("^\.|^log\.txt$", e)]
-    logger.info("Reading in alignments ....")
+    logger.info("Indexing alignments ....")
     alignment_store = ptools.AlignmentStore(clusters=clusters,
                                             genedict=genedict,
                                             allrankids=allrankids,
-                                            indir=alignment_dir, logger=logger)
+                                            indir=alignment_dir, logger=logger,
+                                            lazy=True)
+    # counts of alignment use, success and failure from a previous run
+    alignment_store.restore(phylogeny_dir)
 
     # GENERATE TREE DIST
     logger.info("Generating [{0}] phylogenies ....".format(nphylos))
     generator = ptools.Generator(alignment_store=alignment_store,
                                  rttstat=rttstat, outdir=phylogeny_dir,
                                  maxtrys=maxtrys, logger=logger, wd=temp_dir)
+    generator.backend = backend
+    generator.prescreen = prescreen
+    generator.starts = njstarts
+    generator.batch = batch
+    # searches are checkpointed here, to resume them if the stage restarts
+    generator.checkpoints = os.path.join(temp_dir, 'checkpoints')
+    if not os.path.isdir(generator.checkpoints):
+        os.mkdir(generator.checkpoints)
+    # built-in backend searches are never killed, so are not timed
+    if raxml_timeout and backend.timed:
+        generator.runtimes = ptools.RuntimeModel(logger,
+                                                 multiple=raxml_timeout)
     if 1 == constraint:
         generator.constraint = False
-    for i in range(ptools.countNPhylos(nphylos, outfile)):
-        logger.info(".... Iteration [{0}]".format(i + 1))
-        success = False
-        while not success:
-            success = generator.run()
-        with open(outfile, "a") as file:
-            counter = Phylo.write(generator.phylogenies[-1], file, 'newick')
+    threads = getThreads(wd=temp_dir)
+    if not backend.threaded:
+        # one thread per search, or one search at a time
+        raxml_threads = 1 if backend.concurrent else 0
+    elif 'auto' == raxml_threads:
+        logger.info("Tuning threads per search ....")
+        tuner = ptools.ThreadTuner(threads, logger)
+        raxml_threads = tuner.tune(generator)
+    nsearches, generator.threads = ptools.calcSearches(threads,
+                                                       int(raxml_threads))
+    logger.debug('.... [{0}] searches at once with [{1}] threads each'.
+                 format(nsearches, generator.threads))
+    # count splits as trees are added, including any from a previous run
+    splits = ptools.SplitCounter()
+    splits.read(outfile)
+    if generator.resume():
+        logger.info('Resuming [{0}] interrupted searches ....'.
+                    format(len(generator.resumable)))
+    counter = ptools.generatePhylogenies(generator,
+                                         ptools.countNPhylos(nphylos, outfile),
+                                         outfile, nsearches, logger,
+                                         counter=splits, asdsf=asdsf,
+                                         minphylos=minphylos)
 
     # GENERATE CONSENSUS
     logger.info('Generating consensus ....')
     success = ptools.consensus(phylogeny_dir, min_freq=0.5, is_rooted=True,
-                               trees_splits_encoded=False)
+                               trees_splits_encoded=False, counter=splits)
     if not success:
         logger.info('.... can`t generate consensus, too few names in all trees.')
 
@@ -82,14 +130,34 @@ def run(wd=os.getcwd(), logger=logging.getLogger('')):
     if 3 == constraint:
         logger.info('Repeating unconstrained ....')
         generator.phylogenies = []
+        generator.batched = []
         generator.constraint = False
-        for i in range(ptools.countNPhylos(nphylos, outfile_unconstrained)):
-            logger.info(".... Iteration [{0}]".format(i + 1))
-            success = False
-            while not success:
-                success = generator.run()
-            with open(outfile_unconstrained, "a") as file:
-                counter = Phylo.write(generator.phylogenies[-1], file, 'newick')
+        splits_unconstrained = ptools.SplitCounter()
+        splits_unconstrained.read(outfile_unconstrained)
+        if generator.resume():
+            logger.info('Resuming [{0}] interrupted searches ....'.
+                        format(len(generator.resumable)))
+        counter += ptools.generatePhylogenies(
+            generator, ptools.countNPhylos(nphylos, outfile_unconstrained),
+            outfile_unconstrained, nsearches, logger,
+            counter=splits_unconstrained, asdsf=asdsf, minphylos=minphylos)
+
+    if generator.runtimes:
+        generator.runtimes.save()
+    # searches still checkpointed are no longer needed
+    shutil.rmtree(generator.checkpoints, ignore_errors=True)
+
+    # REPORT ALIGNMENTS USED
+    alignment_store.report(phylogeny_dir)
+    if prescreen:
+        stats = generator.prescreened
+        logger.info('Pre-screen rejected [{0}] of [{1}] draws, [{2}] of [{3}] \
+searched anyway passed'.format(stats['rejected'], stats['screened'],
+                               stats['false_rejects'], stats['audited']))
+
+    if generator.runtimes:
+        logger.info('Killed [{0}] searches that ran past their deadline'.
+                    format(generator.ntimeouts))
 
     # FINISH MESSAGE
     logger.info('Stage finished. Generated [{0}] phylogenies.'.
@@ -6,6 +6,7 @@ pglt tools
 """
 
 import names_tools
+import array_tools
 import alignment_tools
 import entrez_tools
 import download_tools
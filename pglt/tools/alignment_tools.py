@@ -9,21 +9,24 @@ pglt alignment tools
 import os
 import re
 import random
+import shlex
 import numpy as np
 from Bio import SeqIO
 from Bio import AlignIO
 from Bio.Seq import Seq
 from Bio.SeqRecord import SeqRecord
 from Bio.Align import MultipleSeqAlignment
-from Bio.Blast.Applications import NcbiblastnCommandline
-from Bio.Application import ApplicationError
 from Bio.Blast import NCBIXML
 from StringIO import StringIO
 from system_tools import TerminationPipe
+from system_tools import ScratchSpace
 from system_tools import OutgroupError
 from system_tools import TooFewSpeciesError
 from system_tools import MafftError
 from system_tools import TrysError
+from array_tools import ArrayAlignment
+from array_tools import FastaFile
+from array_tools import FastaRecord
 from special_tools import timeit
 from special_tools import getThreads
 from pglt import _MAFFT as mafft
@@ -51,16 +54,21 @@ not align"""
         for i, seqfile in enumerate(seqfiles):
             name = re.sub('\.fasta$', '', seqfile)
             seqdir = os.path.join(genedir, seqfile)
-            seqs = []
-            lengths = []
-            with open(seqdir, "rU") as infile:
-                for record in SeqIO.parse(infile, "fasta"):
-                    record.id = name
-                    lengths.append(len(record))
-                    seqs.append([record, 0])  # seqrecord + nfails
-                    self.nseqs += 1
+            # records are indexed, and only read and parsed when taken
+            fasta = FastaFile(seqdir)
+            seqs = [[record, 0] for record in fasta]  # record + nfails
+            self.nseqs += len(seqs)
             if len(seqs) > 0:
-                self[name] = [seqs, np.min(lengths)]
+                self[name] = [seqs, np.min(fasta.lengths())]
+
+    def _record(self, sp, entry):
+        """Return sequence of entry as a SeqRecord with sp as ID, parsing \
+it on first use"""
+        if isinstance(entry[0], FastaRecord):
+            record = entry[0].toSeqRecord()
+            record.id = sp
+            entry[0] = record
+        return entry[0]
 
     def _add(self, sequences=None, limit=None):
         """Return a random sequence for alignment"""
@@ -75,7 +83,7 @@ not align"""
                 random.shuffle(rand_ints)
             for i in rand_ints:
                 sp = self.sppool[i]
-                next_seqs = [e[0] for e in self[sp][0]]
+                next_seqs = [self._record(sp, e) for e in self[sp][0]]
                 # blast next_seqs against sequences in alignment
                 res = self._alignmentBlast(next_seqs, sequences)
                 # if success break
@@ -97,7 +105,7 @@ not align"""
             result = random.sample(self[self.next_sp][0], 1)[0]
             # record sequence + nfails in sequence_in_alignment
             self.sequences_in_alignment.append(result)
-            next_seq = result[0]
+            next_seq = self._record(self.next_sp, result)
         return next_seq
 
     def _alignmentBlast(self, query, sequences_in_alignment):
@@ -429,89 +437,84 @@ def genNonAlignment(nseqs, alen):
     return MultipleSeqAlignment(seqs)
 
 
+def toFasta(sequences):
+    """Return sequences or alignment as a FASTA string"""
+    handle = StringIO()
+    SeqIO.write(sequences, handle, "fasta")
+    return handle.getvalue()
+
+
 def align(command, sequences, timeout, logger, wd, threads):
     """Adapted pG function: Align sequences using mafft (external
-program)"""
-    input_file = "sequences_in.fasta"
-    output_file = "alignment_out.fasta"
-    command_line = '{0} --thread {1} {2} > {3}'.format(command, threads,
-                                                       input_file, output_file)
-    with open(os.path.join(wd, input_file), "w") as file:
-        SeqIO.write(sequences, file, "fasta")
-    logger.debug(command_line)
-    pipe = TerminationPipe(command_line, timeout=timeout, cwd=wd)
+program). Sequences are piped to MAFFT and the alignment read from its
+stdout."""
+    # `-` tells mafft to read from stdin
+    args = shlex.split(command) + ['--thread', str(threads), '-']
+    logger.debug(' '.join(args))
+    pipe = TerminationPipe(args, timeout=timeout, cwd=wd,
+                           stdin=toFasta(sequences))
     pipe.run()
-    os.remove(os.path.join(wd, input_file))
-    if not pipe.failure:
-        try:
-            res = AlignIO.read(os.path.join(wd, output_file), 'fasta')
-        except:
-            logger.info(pipe.output)
-            raise MafftError()
-        else:
-            os.remove(os.path.join(wd, output_file))
-    else:
+    logger.debug('.... CPU time [{0}] max RSS [{1}]'.format(pipe.cputime,
+                                                              pipe.maxrss))
+    if pipe.failure:
         # if pipe.failure, runtime error, return non-alignment
         logger.debug('.... align timeout ....')
         return genNonAlignment(len(sequences), len(sequences[0]))
+    try:
+        res = AlignIO.read(StringIO(pipe.stdout), 'fasta')
+    except:
+        logger.info(pipe.output)
+        raise MafftError()
     return res
 
 
 def add(alignment, sequence, timeout, logger, wd, threads):
     """Align sequence(s) to an alignment using mafft (external
-program)"""
-    alignment_file = "alignment_in.fasta"
-    sequence_file = "sequence_in.fasta"
-    output_file = "alignment_out.fasta" + '.fasta'
-    command_line = '{0} --auto --thread {1} --add {2} {3} > {4}'.\
-                   format(mafft, threads, sequence_file, alignment_file,
-                          output_file)
-    with open(os.path.join(wd, sequence_file), "w") as file:
-        SeqIO.write(sequence, file, "fasta")
-    with open(os.path.join(wd, alignment_file), "w") as file:
-        AlignIO.write(alignment, file, "fasta")
-    pipe = TerminationPipe(command_line, timeout=timeout, cwd=wd)
-    pipe.run()
-    os.remove(os.path.join(wd, alignment_file))
-    os.remove(os.path.join(wd, sequence_file))
-    if not pipe.failure:
-        try:
-            res = AlignIO.read(os.path.join(wd, output_file), 'fasta')
-        except:
-            logger.info(pipe.output)
-            raise MafftError()
-        else:
-            os.remove(os.path.join(wd, output_file))
-    else:
+program). The alignment is piped to MAFFT and the result read from its
+stdout."""
+    with ScratchSpace(wd) as scratch:
+        sequence_file = os.path.join(scratch, "sequence_in.fasta")
+        with open(sequence_file, "w") as file:
+            SeqIO.write(sequence, file, "fasta")
+        args = shlex.split(mafft) + ['--auto', '--thread', str(threads),
+                                     '--add', sequence_file, '-']
+        logger.debug(' '.join(args))
+        pipe = TerminationPipe(args, timeout=timeout, cwd=scratch,
+                               stdin=toFasta(alignment))
+        pipe.run()
+    logger.debug('.... CPU time [{0}] max RSS [{1}]'.format(pipe.cputime,
+                                                              pipe.maxrss))
+    if pipe.failure:
         logger.debug('.... add timeout ....')
         return genNonAlignment(len(alignment) + 1,
-                               len(alignment.get_alignment_length()))
+                               alignment.get_alignment_length())
+    try:
+        res = AlignIO.read(StringIO(pipe.stdout), 'fasta')
+    except:
+        logger.info(pipe.output)
+        raise MafftError()
     return res
 
 
 def blast(query, subj, minoverlap, logger, wd, threads):
     """Return bool and positions of query sequences that overlapped
 with subject given parameters."""
-    query_file = os.path.join(wd, 'query.fasta')
-    subj_file = os.path.join(wd, 'subj.fasta')
-    SeqIO.write(query, query_file, "fasta")
-    SeqIO.write(subj, subj_file, "fasta")
-    try:
+    with ScratchSpace(wd) as scratch:
+        subj_file = os.path.join(scratch, 'subj.fasta')
+        SeqIO.write(subj, subj_file, "fasta")
         # options: http://www.ncbi.nlm.nih.gov/books/NBK1763/
-        cline = NcbiblastnCommandline(query=query_file, subject=subj_file,
-                                      outfmt=5, cmd=blastn, word_size=8,
-                                      num_threads=threads)
-        logger.debug(cline)
-        output = cline()[0]
-    except ApplicationError:  # as error_msg:
-        # logger.debug(error_msg)
-        # logger.warn("---- BLAST Error ----")
+        # query is read from stdin
+        args = shlex.split(blastn) + ['-query', '-', '-subject', subj_file,
+                                      '-outfmt', '5', '-word_size', '8',
+                                      '-num_threads', str(threads)]
+        logger.debug(' '.join(args))
+        pipe = TerminationPipe(args, cwd=scratch, stdin=toFasta(query))
+        pipe.run()
+    if pipe.failure or pipe.returncode != 0:
         # TODO: work out why this is happening, doesn't seem to affect
         #  results though, low priority
         return [], []
-    finally:
-        os.remove(query_file)
-        os.remove(subj_file)
+    output = pipe.stdout
     # list of T or F for success of alignment between queries and
     #  subject
     bools = []
@@ -533,44 +536,49 @@ with subject given parameters."""
     return bools, positions
 
 
+def alignmentMatrix(alignment):
+    """Return alignment as a (nseqs x alignment length) uint8 matrix"""
+    if isinstance(alignment, ArrayAlignment):
+        return alignment.matrix
+    sequences = ''.join([str(record.seq) for record in alignment])
+    matrix = np.frombuffer(sequences, dtype=np.uint8)
+    return matrix.reshape(len(alignment), -1)
+
+
+def alignmentStats(alignment):
+    """Return number of gaps (runs of `-`) and overlap for each sequence \
+in alignment. Overlap is the number of nucleotides of a sequence less the \
+mean proportion of other sequences with gaps at those nucleotides."""
+    gaps = alignmentMatrix(alignment) == ord('-')
+    nucs = ~gaps
+    # proportion of other sequences with a gap in each column
+    pcolgaps = gaps.sum(axis=0) / float(max(len(gaps) - 1, 1))
+    overlaps = nucs.sum(axis=1) - np.dot(nucs, pcolgaps)
+    # a run of gaps starts at a gap not preceded by a gap
+    starts = gaps.copy()
+    starts[:, 1:] &= nucs[:, :-1]
+    ngaps = starts.sum(axis=1)
+    return ngaps, overlaps
+
+
 def checkAlignment(alignment, maxgaps, minoverlap, minlen, logger):
     """Determine if an alignment is good or not based on given \
 parameters. Return bool"""
-    # TODO: too complex, consider breaking up
-    # internals
-    def calcOverlap(columns):
-        if not columns:
-            return 0
-        # what proportion of columns have nucs in other seqs
-        pcolgaps = []
-        for i in columns:
-            ith = float(alignment[:, i].count("-"))/(len(alignment)-1)
-            pcolgaps.append(ith)
-        # overlap is the mean proportion of columns shared
-        overlap = len(columns) - (len(columns) * np.mean(pcolgaps))
-        return overlap
-
-    def calcNgap(sequence):
-        # count the number of gaps
-        gaps = re.subn('-+', '', sequence)[1]
-        return float(gaps)
-
-    # process
     if alignment is None:
         return False
     alen = alignment.get_alignment_length()
     if alen < minlen:
         logger.debug('........ alignment too small')
         return False
-    for each in alignment:
-        sequence = str(each.seq)
-        columns = [ei for ei, e in enumerate(sequence) if e != "-"]
-        overlap = calcOverlap(columns)
-        if overlap < minoverlap:
+    ngaps, overlaps = alignmentStats(alignment)
+    too_little_overlap = overlaps < minoverlap
+    too_many_gaps = ngaps > maxgaps
+    failed = too_little_overlap | too_many_gaps
+    if failed.any():
+        # report on first failing sequence, overlap is checked first
+        if too_little_overlap[np.argmax(failed)]:
             logger.debug('........ alignment too little overlap')
-            return False
-        ngap = calcNgap(sequence)
-        if ngap > maxgaps:
+        else:
             logger.debug('........ alignment too many gaps')
-            return False
+        return False
     return True
@@ -0,0 +1,337 @@
+#! /bin/usr/env python
+# 19/10/2026
+"""
+pglt array tools
+"""
+
+# PACKAGES
+import os
+import mmap
+import numpy as np
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+from Bio.Alphabet import single_letter_alphabet
+from Bio.Align import MultipleSeqAlignment
+
+
+# CLASSES
+class ArrayRecord(object):
+    """Light-weight sequence record: a row of an ArrayAlignment"""
+    __slots__ = ('id', 'description', 'row')
+
+    def __init__(self, id, row, description=''):
+        self.id = id
+        self.row = row
+        self.description = description
+
+    @property
+    def name(self):
+        return self.id
+
+    @property
+    def seq(self):
+        return self.row.tostring()
+
+    def __len__(self):
+        return len(self.row)
+
+    def __str__(self):
+        return self.seq
+
+
+class ArrayAlignment(object):
+    """Alignment held as a contiguous (nseqs x alignment length) uint8 \
+matrix with an ID index. Row and column slices are views of the same \
+matrix, not copies. Behaves enough like a Biopython MultipleSeqAlignment \
+for pglt: len(), iteration over records, get_alignment_length() and \
+[rows, columns] slicing."""
+
+    def __init__(self, ids, matrix, descriptions=None):
+        if len(ids) != matrix.shape[0]:
+            raise ValueError('Number of IDs and rows do not match')
+        self.ids = list(ids)
+        self.matrix = matrix
+        if descriptions is None:
+            descriptions = [''] * len(self.ids)
+        self.descriptions = list(descriptions)
+        self.index = dict([(e, i) for i, e in enumerate(self.ids)])
+        # file the alignment was read from, if any
+        self.path = None
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield ArrayRecord(self.ids[i], self.matrix[i],
+                              self.descriptions[i])
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            rows, columns = key
+        else:
+            rows, columns = key, slice(None)
+        if isinstance(rows, int):
+            if columns != slice(None):
+                raise IndexError('Use [:, columns] to slice columns')
+            return ArrayRecord(self.ids[rows], self.matrix[rows],
+                               self.descriptions[rows])
+        if isinstance(columns, int):
+            # a single column, as a string
+            return self.matrix[rows, columns].tostring()
+        return ArrayAlignment(self.ids[rows], self.matrix[rows, columns],
+                              self.descriptions[rows])
+
+    def get_alignment_length(self):
+        return self.matrix.shape[1]
+
+    def sequence(self, txid):
+        """Return row of matrix for ID"""
+        return self.matrix[self.index[txid]]
+
+    def column(self, i):
+        """Return column i of matrix"""
+        return self.matrix[:, i]
+
+    def frame(self, start):
+        """Return view of alignment from start, trimmed to whole codons"""
+        end = start + (self.get_alignment_length() - start) // 3 * 3
+        return self[:, start:end]
+
+    def toBio(self):
+        """Return as a Biopython MultipleSeqAlignment"""
+        return MultipleSeqAlignment([SeqRecord(Seq(record.seq), id=record.id,
+                                               description=record.description)
+                                     for record in self])
+
+    @classmethod
+    def fromSequences(klass, ids, sequences, descriptions=None):
+        """Return ArrayAlignment from lists of IDs and sequence strings"""
+        lengths = set([len(e) for e in sequences])
+        if len(lengths) > 1:
+            raise ValueError('Sequences must all be the same length')
+        if not sequences:
+            return klass([], np.zeros((0, 0), dtype=np.uint8), descriptions)
+        matrix = np.frombuffer(''.join(sequences), dtype=np.uint8)
+        return klass(ids, matrix.reshape(len(ids), -1), descriptions)
+
+    @classmethod
+    def fromBio(klass, alignment):
+        """Return ArrayAlignment from a Biopython alignment (or any \
+iterable of records with id and seq)"""
+        ids = []
+        sequences = []
+        descriptions = []
+        for record in alignment:
+            ids.append(record.id)
+            sequences.append(str(record.seq))
+            descriptions.append(getattr(record, 'description', ''))
+        return klass.fromSequences(ids, sequences, descriptions)
+
+    def write(self, handle, fmt='fasta'):
+        """Write to handle as `fasta` or `phylip-relaxed`"""
+        if fmt == 'fasta':
+            for i, txid in enumerate(self.ids):
+                # as Biopython: ID then description, unless it starts with ID
+                title = self.descriptions[i]
+                if not title:
+                    title = txid
+                elif title.split(None, 1)[0] != txid:
+                    title = '{0} {1}'.format(txid, title)
+                handle.write('>{0}\n'.format(title))
+                handle.write(self.matrix[i].tostring() + '\n')
+        elif fmt == 'phylip-relaxed':
+            # sequential relaxed PHYLIP as read by RAxML
+            handle.write('{0} {1}\n'.format(len(self),
+                                            self.get_alignment_length()))
+            width = max([len(e) for e in self.ids]) + 1
+            for i, txid in enumerate(self.ids):
+                handle.write(txid.ljust(width) +
+                             self.matrix[i].tostring() + '\n')
+        else:
+            raise ValueError('Unknown format [{0}]'.format(fmt))
+
+
+class FastaRecord(object):
+    """Record of a FastaFile, parsed from the file on first use"""
+    __slots__ = ('fasta', 'i', '_title', '_seq')
+
+    def __init__(self, fasta, i):
+        self.fasta = fasta
+        self.i = i
+        self._title = None
+        self._seq = None
+
+    @property
+    def description(self):
+        if self._title is None:
+            self._title = self.fasta.title(self.i)
+        return self._title
+
+    @property
+    def id(self):
+        return self.description.split(None, 1)[0] if self.description \
+            else ''
+
+    @property
+    def name(self):
+        return self.id
+
+    @property
+    def seq(self):
+        if self._seq is None:
+            self._seq = self.fasta.sequence(self.i)
+        return self._seq
+
+    def __len__(self):
+        return len(self.seq)
+
+    def toSeqRecord(self):
+        """Return as a Biopython SeqRecord"""
+        return SeqRecord(Seq(self.seq, single_letter_alphabet), id=self.id,
+                         name=self.id, description=self.description)
+
+
+class FastaFile(object):
+    """Indexed FASTA file. Record boundaries and lengths are found when \
+the file is opened, records are only read and parsed when used."""
+
+    def __init__(self, path):
+        self.path = path
+        # map only while indexing, an open map holds a file descriptor
+        with open(path, 'rb') as file:
+            if os.fstat(file.fileno()).st_size:
+                data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                data = ''
+        try:
+            self._index(data)
+        finally:
+            if not isinstance(data, str):
+                data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __deepcopy__(self, memo):
+        # read only, so copies can share the index
+        return self
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, i):
+        return FastaRecord(self, i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield FastaRecord(self, i)
+
+    def _index(self, data):
+        # find start of each header, body and record
+        self.starts = []
+        if data[:1] == '>':
+            self.starts.append(0)
+        i = data.find('\n>')
+        while i != -1:
+            self.starts.append(i + 1)
+            i = data.find('\n>', i + 1)
+        self.ends = self.starts[1:] + [len(data)]
+        self.bodies = []
+        self._lengths = []
+        for start, end in zip(self.starts, self.ends):
+            i = data.find('\n', start, end)
+            body = end if i == -1 else i + 1
+            self.bodies.append(body)
+            block = data[body:end]
+            self._lengths.append(len(block) - sum([block.count(e) for e in
+                                                    ' \t\r\n']))
+
+    def _read(self, start, end):
+        with open(self.path, 'rb') as file:
+            file.seek(start)
+            return file.read(end - start)
+
+    def close(self):
+        # nothing is kept open
+        pass
+
+    def title(self, i):
+        """Return header line of record i"""
+        return self._read(self.starts[i] + 1, self.bodies[i]).strip()
+
+    def sequence(self, i):
+        """Return sequence of record i"""
+        return self._read(self.bodies[i], self.ends[i]).\
+            translate(None, ' \t\r\n')
+
+    def lengths(self):
+        """Return sequence length of each record"""
+        return list(self._lengths)
+
+    def toAlignment(self):
+        """Return records as an ArrayAlignment"""
+        with open(self.path, 'rb') as file:
+            ids, descriptions, sequences = parseFasta(file.read())
+        return ArrayAlignment.fromSequences(ids, sequences, descriptions)
+
+
+# FUNCTIONS
+def readFastaFile(path):
+    """Return ArrayAlignment from FASTA file at path"""
+    with FastaFile(path) as fasta:
+        alignment = fasta.toAlignment()
+    alignment.path = path
+    return alignment
+
+
+def asArray(alignment):
+    """Return alignment as an ArrayAlignment, converting if necessary"""
+    if isinstance(alignment, ArrayAlignment):
+        return alignment
+    return ArrayAlignment.fromBio(alignment)
+
+
+def parseFasta(text):
+    """Return IDs, descriptions and sequences from FASTA text"""
+    ids = []
+    descriptions = []
+    sequences = []
+    text = text.lstrip()
+    if not text:
+        return ids, descriptions, sequences
+    if not text.startswith('>'):
+        raise ValueError('FASTA text must start with `>`')
+    for block in text[1:].split('\n>'):
+        title, _, sequence = block.partition('\n')
+        title = title.strip()
+        ids.append(title.split(None, 1)[0] if title else '')
+        descriptions.append(title)
+        sequences.append(sequence.translate(None, ' \t\r\n'))
+    return ids, descriptions, sequences
+
+
+def readFasta(handle):
+    """Return ArrayAlignment from FASTA file handle"""
+    ids, descriptions, sequences = parseFasta(handle.read())
+    return ArrayAlignment.fromSequences(ids, sequences, descriptions)
+
+
+def readPhylip(handle):
+    """Return ArrayAlignment from sequential relaxed PHYLIP file handle"""
+    nseqs, alen = [int(e) for e in handle.readline().split()]
+    ids = []
+    sequences = []
+    for line in handle:
+        line = line.strip()
+        if not line:
+            continue
+        txid, sequence = line.split(None, 1)
+        ids.append(txid)
+        sequences.append(sequence.translate(None, ' \t'))
+    if len(ids) != nseqs or any([len(e) != alen for e in sequences]):
+        raise ValueError('PHYLIP header does not match sequences')
+    return ArrayAlignment.fromSequences(ids, sequences)
@@ -8,19 +8,49 @@ pglt phylogeny tools
 # Packages
 import os
 import re
+import abc
+import errno
+import csv
+import array
 import random
 import logging
+import shutil
+import signal
+import pickle
+import tempfile
+import threading
+import itertools
+import Queue
+import time
+import platform
+import numpy as np
 from collections import Counter
-from Bio.Align import MultipleSeqAlignment
-from Bio.SeqRecord import SeqRecord
+from collections import OrderedDict
+from StringIO import StringIO
 from Bio import Phylo
-from Bio import AlignIO
-import dendropy as dp
-from math import sqrt
 from system_tools import TerminationPipe
+from system_tools import ScratchSpace
+from system_tools import PipeSet
 from system_tools import RAxMLError
+from array_tools import ArrayAlignment
+from array_tools import asArray
+from array_tools import readFastaFile
 from special_tools import getThreads
 from pglt import _RAXML as raxml
+from pglt import _RAXMLNG as raxmlng
+from pglt import _FASTTREE as fasttree
+
+
+# GLOBALS
+# codes of nucleotide bytes for stop codon lookup tables
+#  (stop patterns only match codons of these nucleotides)
+_nuc_codes = np.repeat(np.int16(8), 256)
+_nuc_codes[[ord(e) for e in 'acgtACGT']] = range(8)
+_stop_tables = {}
+# tokens of Newick strings: comments, quoted labels, punctuation, branch
+#  lengths and unquoted labels
+_newick_tokens = re.compile(r"\[[^\]]*\]|'(?:[^']|'')*'|[(),;]|"
+                            r":[^(),;\[\]]*|[^(),;:\[\]'\s]+")
 
 
 # CLASSES
@@ -59,11 +89,30 @@ class StopCodonRetriever(object):
 
 
 class AlignmentStore(dict):
-    """Alignment holding class"""
+    """Alignment holding class : if lazy, alignments are read when drawn \
+and kept in a cache of cache_size"""
     retriever = StopCodonRetriever()
+    frames_file = '.frames.p'
+    report_file = 'alignments_report.csv'
+    counts_file = '.alignment_counts.p'
+    max_failures = 10
+    save_interval = 10  # counts between saves
 
-    def __init__(self, clusters, genedict, allrankids, indir, logger):
+    def __init__(self, clusters, genedict, allrankids, indir, logger,
+                 lazy=False, cache_size=None):
         self.logger = logger
+        self.lazy = lazy
+        if cache_size is None:
+            # enough for the current and the prefetched draw
+            cache_size = 2 * len(clusters)
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.prefetcher = None
+        self.draw = None
+        self.index = {}  # (gene, i) of each alignment path
+        self.outdir = None  # where counts are saved
+        self.ncounts = 0
         # Read in alignments for each cluster
         # first find corresponding gene name for each cluster
         genes = []
@@ -71,59 +120,661 @@ class AlignmentStore(dict):
             genes.append(re.sub('_cluster[0-9]+', '', cluster))
         for cluster, gene in zip(clusters, genes):
             # add a key to the AlignmentStore dict
-            self[cluster] = {'alignments': [], 'files': [], 'counters': []}
+            self[cluster] = {'alignments': [], 'files': [], 'paths': [],
+                             'sizes': [], 'mtimes': [], 'counters': [],
+                             'successes': [], 'failures': [], 'partners': []}
             # retrieve its stop codon if it's mt
             self[cluster]['stop'] =\
                 self.retriever.pattern(ids=allrankids, logger=self.logger,
                                        genome_type=genedict[gene]
                                        ['partition'].lower())
-            # find corresponding input dir and read in alignments
+            # find corresponding input dir and index (or read in) alignments
             cluster_dir = os.path.join(indir, cluster)
+            self[cluster]['dir'] = cluster_dir
+            self[cluster]['frames'] = self._readFrames(cluster_dir)
             alignment_files = os.listdir(cluster_dir)
             alignment_files = [e for e in alignment_files if
-                               not re.search("^\.", e)]
+                               not re.search("^\.|^log\.txt$", e)]
             for alignment_file in alignment_files:
-                with open(os.path.join(cluster_dir, alignment_file), "r") \
-                        as file:
-                    alignment = AlignIO.read(file, "fasta")
-                self[cluster]['alignments'].append(alignment)
+                path = os.path.join(cluster_dir, alignment_file)
                 self[cluster]['files'].append(alignment_file)
+                self[cluster]['paths'].append(path)
+                stat = os.stat(path)
+                self[cluster]['sizes'].append(stat.st_size)
+                self[cluster]['mtimes'].append(stat.st_mtime)
                 self[cluster]['counters'].append(0)
+                self[cluster]['successes'].append(0)
+                self[cluster]['failures'].append(0)
+                # other alignments of each failed draw
+                self[cluster]['partners'].append(set())
+                self.index[path] = (cluster, len(self[cluster]['paths']) - 1)
+                if not lazy:
+                    self[cluster]['alignments'].append(readFastaFile(path))
+
+    def _load(self, path):
+        """Return alignment at path, from cache if possible"""
+        with self.lock:
+            if path in self.cache:
+                # move to most recently used
+                alignment = self.cache.pop(path)
+                self.cache[path] = alignment
+                return alignment
+        alignment = readFastaFile(path)
+        with self.lock:
+            self.cache[path] = alignment
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return alignment
 
-    def count(self):
-        """Add to alignments' counters"""
-        for each in self.counters:
-            each += 1
+    def _readFrames(self, cluster_dir):
+        """Return cached frames of cluster"""
+        try:
+            with open(os.path.join(cluster_dir, self.frames_file), 'rb') \
+                    as file:
+                return pickle.load(file)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return {}
 
-    def report(self):
-        """Return info on alignments used"""
-        # TODO: find a way to record alignments used
-        pass
+    def _writeFrames(self, gene):
+        """Write cached frames of gene, via a temporary file"""
+        path = os.path.join(self[gene]['dir'], self.frames_file)
+        try:
+            with open(path + '.tmp', 'wb') as file:
+                pickle.dump(self[gene]['frames'], file)
+            os.rename(path + '.tmp', path)
+        except (IOError, OSError):
+            self.logger.debug('.... could not write [{0}]'.format(path))
+
+    def _frame(self, gene, i, alignment):
+        """Return reading frame of ith alignment of gene, finding it if not \
+already cached for the file's size, modification time and stop pattern"""
+        genedata = self[gene]
+        if not genedata['stop']:
+            return None
+        afile = genedata['files'][i]
+        key = (genedata['sizes'][i], genedata['mtimes'][i],
+               stopKey(genedata['stop']))
+        with self.lock:
+            cached = genedata['frames'].get(afile)
+        if cached and cached[0] == key:
+            return cached[1]
+        frame = findFrame(alignment, genedata['stop'])
+        with self.lock:
+            genedata['frames'][afile] = (key, frame)
+            self._writeFrames(gene)
+        return frame
+
+    def _alignment(self, gene, i):
+        """Return ith alignment of gene"""
+        if self.lazy:
+            return self._load(self[gene]['paths'][i])
+        return self[gene]['alignments'][i]
+
+    def _weights(self, gene):
+        """Return sampling weight of each alignment of gene: its rate of \
+success, with one prior success and failure, or 0 if it has failed \
+max_failures times (with enough other alignments) without passing"""
+        genedata = self[gene]
+        # failures must be with max_failures different draws of the other
+        #  genes, or as many as there are
+        npartners = 1
+        for other in self.keys():
+            if other != gene:
+                npartners *= len(self[other]['paths'])
+        npartners = min(npartners, self.max_failures)
+        with self.lock:
+            outcomes = zip(genedata['successes'], genedata['failures'],
+                           [len(e) for e in genedata['partners']])
+        weights = [(s + 1.) / (s + f + 2.) for s, f, _ in outcomes]
+        blacklisted = [not s and f >= self.max_failures and p >= npartners
+                       for s, f, p in outcomes]
+        if not all(blacklisted):
+            weights = [0. if b else w for w, b in zip(weights, blacklisted)]
+        return weights
+
+    def _draw(self):
+        """Return random alignment index for each gene, weighted by success"""
+        draw = []
+        for gene in self.keys():
+            weights = self._weights(gene)
+            r = random.random() * sum(weights)
+            for i, weight in enumerate(weights):
+                r -= weight
+                if r < 0:
+                    break
+            else:
+                # rounding error, take the last drawable alignment
+                i = max([j for j, e in enumerate(weights) if e > 0])
+            draw.append(i)
+        return draw
+
+    def _prefetch(self, draw):
+        """Read alignments of draw into cache"""
+        for gene, i in zip(self.keys(), draw):
+            self._load(self[gene]['paths'][i])
+
+    def count(self, alignments, success):
+        """Add success or failure of a phylogeny to its alignments' counts. \
+If a failure stops an alignment of the prefetched draw being drawn, draw \
+and read another."""
+        key = 'successes' if success else 'failures'
+        draw = [self.index[e.path] for e in alignments if
+                getattr(e, 'path', None) in self.index]
+        with self.lock:
+            for gene, i in draw:
+                self[gene][key][i] += 1
+                if not success:
+                    self[gene]['partners'][i].add(tuple(
+                        [e for e in draw if e[0] != gene]))
+            self.ncounts += 1
+            save = self.outdir and not self.ncounts % self.save_interval
+        if save:
+            self.save()
+        if not success:
+            self._redraw()
+
+    def _redraw(self):
+        """Replace prefetched draw if any of its alignments is no longer \
+drawn"""
+        with self.lock:
+            draw = self.draw
+        if draw is None:
+            return
+        if all([self._weights(gene)[i] for gene, i in zip(self.keys(),
+                                                           draw)]):
+            return
+        with self.lock:
+            if self.draw is not draw:
+                # already pulled
+                return
+            self.draw = None
+        self._prefetchNext()
+
+    def _prefetchNext(self):
+        """Draw next alignments, weighted by the counts so far, and read \
+them into cache in the background"""
+        if not self.lazy:
+            return
+        with self.lock:
+            if self.draw is not None:
+                return
+        draw = self._draw()
+        with self.lock:
+            if self.draw is not None:
+                return
+            self.draw = draw
+            self.prefetcher = threading.Thread(target=self._prefetch,
+                                               args=(draw,))
+            self.prefetcher.daemon = True
+            self.prefetcher.start()
+
+    def restore(self, outdir):
+        """Read counts saved to counts_file in outdir by a previous run, \
+and save counts there from now on"""
+        self.outdir = outdir
+        try:
+            with open(os.path.join(outdir, self.counts_file), 'rb') as file:
+                saved = pickle.load(file)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return
+        # saved by gene and file name, alignment indexes may differ
+        indexes = dict([((gene, e), (gene, i)) for gene in self.keys() for
+                        i, e in enumerate(self[gene]['files'])])
+        with self.lock:
+            for (gene, afile), counts in saved.iteritems():
+                if (gene, afile) not in indexes:
+                    continue
+                i = indexes[(gene, afile)][1]
+                counter, successes, failures, partners = counts
+                self[gene]['counters'][i] = counter
+                self[gene]['successes'][i] = successes
+                self[gene]['failures'][i] = failures
+                self[gene]['partners'][i] = set(
+                    [tuple([indexes[e] for e in draw]) for draw in partners
+                     if all([e in indexes for e in draw])])
+
+    def save(self):
+        """Write counts to counts_file in outdir, via a temporary file"""
+        saved = {}
+        with self.lock:
+            for gene in self.keys():
+                genedata = self[gene]
+                for i, afile in enumerate(genedata['files']):
+                    partners = [tuple([(g, self[g]['files'][j]) for g, j in
+                                       draw]) for draw in
+                                genedata['partners'][i]]
+                    saved[(gene, afile)] = (
+                        genedata['counters'][i], genedata['successes'][i],
+                        genedata['failures'][i], partners)
+        path = os.path.join(self.outdir, self.counts_file)
+        try:
+            with open(path + '.tmp', 'wb') as file:
+                pickle.dump(saved, file)
+            os.rename(path + '.tmp', path)
+        except (IOError, OSError):
+            self.logger.debug('.... could not write [{0}]'.format(path))
+
+    def report(self, outdir):
+        """Write uses, successes and failures of each alignment to \
+report_file in outdir (and save counts, if kept)"""
+        if self.outdir:
+            self.save()
+        headers = ['gene', 'alignment', 'used', 'successes', 'failures']
+        with open(os.path.join(outdir, self.report_file), 'wb') as file:
+            writer = csv.writer(file)
+            writer.writerow(headers)
+            for gene in sorted(self.keys()):
+                genedata = self[gene]
+                for row in zip(genedata['files'], genedata['counters'],
+                               genedata['successes'], genedata['failures']):
+                    writer.writerow([gene] + list(row))
+
+    def load(self, draw):
+        """Return list of alignments and reading frames (None if not codon \
+partitioned) of draw (an alignment index for each gene), without counting \
+their use"""
+        alignments = []
+        frames = []
+        for gene, i in zip(self.keys(), draw):
+            alignment = self._alignment(gene, i)
+            alignments.append(alignment)
+            frames.append(self._frame(gene, i, alignment))
+        return alignments, frames
 
     def pull(self):
         """Randomly select an alignment for each gene. Return
-list of alignments and stop pattern if partition"""
-        self.counters = []
-        alignments = []
-        stops = []
+list of alignments and reading frames (None if not codon partitioned)"""
         self.logger.info("........ Using alignments:")
-        for gene in self.keys():
+        if self.prefetcher:
+            self.prefetcher.join()
+        with self.lock:
+            draw, self.draw = self.draw, None
+        if draw is None:
+            draw = self._draw()
+        alignments, frames = self.load(draw)
+        # read the next draw while this one is searched
+        self._prefetchNext()
+        for j, (gene, i) in enumerate(zip(self.keys(), draw)):
             genedata = self[gene]
-            i = random.randint(0, len(genedata['alignments']) - 1)
-            alignments.append(genedata['alignments'][i])
-            stops.append(genedata['stop'])
-            self.counters.append(genedata['counters'][i])
+            with self.lock:
+                genedata['counters'][i] += 1
             afile = genedata['files'][i]
-            if genedata['stop']:
+            if frames[j] is not None:
                 self.logger.info("............ {0}(codon partitioned):\
 [{1}]".format(gene, afile))
             else:
                 self.logger.info("............ {0}:[{1}]".format(gene, afile))
-        return alignments, stops
+        return alignments, frames
+
+
+class ThreadTuner(object):
+    """RAxML thread tuning class : choose threads per search (and so the \
+number of concurrent searches) that generates the most trees per second. \
+Search times for each number of threads are predicted from a calibration \
+of alignments of similar size (taxa x distinct patterns) on this machine, \
+or else measured by running RAxML on the alignments and added to the \
+calibration. The trees of timed searches are kept by the generator. \
+Calibrations are kept in path, per machine."""
+    path = os.path.join(os.path.expanduser('~'), '.pglt', 'calibration.p')
+    tolerance = 2.0  # max fold difference in size of calibrated alignments
+
+    def __init__(self, threads, logger, path=None):
+        self.threads = threads
+        self.logger = logger
+        if path:
+            self.path = path
+        self.machine = platform.node()
+        self.calibration = self._read()
+
+    def _read(self):
+        """Return calibration of this machine"""
+        try:
+            with open(self.path, 'rb') as file:
+                return pickle.load(file).get(self.machine, [])
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return []
+
+    def _write(self):
+        """Add calibration of this machine to calibrations in path"""
+        try:
+            with open(self.path, 'rb') as file:
+                calibrations = pickle.load(file)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            calibrations = {}
+        calibrations[self.machine] = self.calibration
+        try:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(self.path + '.tmp', 'wb') as file:
+                pickle.dump(calibrations, file)
+            os.rename(self.path + '.tmp', self.path)
+        except (IOError, OSError):
+            self.logger.debug('.... could not write [{0}]'.format(self.path))
+
+    def candidates(self):
+        """Return numbers of threads per search to try"""
+        candidates = []
+        raxml_threads = 1
+        while raxml_threads < self.threads:
+            candidates.append(raxml_threads)
+            raxml_threads *= 2
+        return candidates + [self.threads]
+
+    def predict(self, size):
+        """Return predicted seconds per search for each candidate for an \
+alignment of size (taxa x distinct patterns), None if not calibrated"""
+        seconds = {}
+        for ntaxa, npatterns, raxml_threads, secs in self.calibration:
+            ratio = float(size) / (ntaxa * npatterns)
+            if 1.0 / self.tolerance <= ratio <= self.tolerance:
+                seconds.setdefault(raxml_threads, []).append(secs * ratio)
+        if not all([e in seconds for e in self.candidates()]):
+            return None
+        return dict([(e, np.mean(seconds[e])) for e in self.candidates()])
+
+    def best(self, seconds):
+        """Return threads per search with most searches per second"""
+        rates = [((self.threads // e) / max(seconds[e], 1e-6), -e) for e in
+                 self.candidates()]
+        return -max(rates)[1]
+
+    def measure(self, generator, alignments, frames):
+        """Return seconds per search for each candidate, timed by searching \
+alignments with generator"""
+        alignment = generator._supermatrix(alignments, frames)[0]
+        ntaxa, npatterns = len(alignment), countPatterns(alignment)
+        seconds = {}
+        phylogenies = []
+        for raxml_threads in self.candidates():
+            start = time.time()
+            phylogenies.append(generator._search(alignments, frames,
+                                                 raxml_threads + 1))
+            seconds[raxml_threads] = time.time() - start
+            self.calibration.append((ntaxa, npatterns, raxml_threads,
+                                     seconds[raxml_threads]))
+            self.logger.debug('.... [{0}] threads: [{1}] seconds'.
+                              format(raxml_threads, seconds[raxml_threads]))
+        self._write()
+        # don't waste the timed searches
+        generator.keep(alignments, phylogenies)
+        return seconds
+
+    def tune(self, generator):
+        """Return threads per search for generator's alignments"""
+        if len(self.candidates()) == 1:
+            return self.threads
+        store = generator.alignment_store
+        alignments, frames = store.load(store._draw())
+        alignment = generator._supermatrix(alignments, frames)[0]
+        size = len(alignment) * countPatterns(alignment)
+        seconds = self.predict(size)
+        if seconds is None:
+            self.logger.info('.... timing RAxML searches')
+            seconds = self.measure(generator, alignments, frames)
+        return self.best(seconds)
+
+
+class RuntimeModel(object):
+    """Search runtime model class : predict seconds per search from the \
+numbers of taxa, distinct patterns, partitions and threads, by a log-log \
+least squares fit to past searches of the same key (backend and model, see \
+Backend.key) on this machine, or for the first few the slowest seconds per \
+taxon x pattern. Searches are given a deadline of multiple times the \
+prediction. Timed out searches count as lower bounds. Searches and \
+timeouts are kept in path, per machine and key, written every \
+save_interval searches and on save()."""
+    path = os.path.join(os.path.expanduser('~'), '.pglt', 'runtimes.p')
+    min_fit = 10  # min searches for the fit
+    min_deadline = 60.0  # never kill a search sooner than this
+    max_records = 500
+    save_interval = 10  # searches between writes
+    fit_iterations = 5  # refits with timeouts raised to their predictions
+
+    def __init__(self, logger, multiple=10, path=None):
+        self.logger = logger
+        self.multiple = multiple
+        if path:
+            self.path = path
+        self.machine = platform.node()
+        self.lock = threading.Lock()
+        # searches and timeouts by key
+        self.records = {}
+        self.timeouts = {}
+        for key, (records, timeouts) in self._read().items():
+            self.records[key] = records
+            self.timeouts[key] = timeouts
+        self.unsaved = 0
+        self.coefficients = dict([(e, self._fit(e)) for e in self.records])
+
+    def _read(self):
+        """Return past searches and timeouts of this machine by key"""
+        try:
+            with open(self.path, 'rb') as file:
+                runtimes = pickle.load(file).get(self.machine, {})
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return {}
+        # not kept by key before
+        return runtimes if isinstance(runtimes, dict) else {}
+
+    def _write(self):
+        """Add searches and timeouts of this machine to those in path"""
+        try:
+            with open(self.path, 'rb') as file:
+                runtimes = pickle.load(file)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            runtimes = {}
+        runtimes[self.machine] = dict([(e, (self.records[e],
+                                            self.timeouts[e])) for e in
+                                       self.records])
+        try:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(self.path + '.tmp', 'wb') as file:
+                pickle.dump(runtimes, file)
+            os.rename(self.path + '.tmp', self.path)
+        except (IOError, OSError):
+            self.logger.debug('.... could not write [{0}]'.format(self.path))
+
+    def _features(self, ntaxa, npatterns, npartitions, threads):
+        return [1.0, np.log(ntaxa), np.log(npatterns), np.log(npartitions),
+                np.log(threads)]
+
+    def save(self):
+        """Write searches and timeouts not yet written"""
+        with self.lock:
+            if self.unsaved:
+                self._write()
+                self.unsaved = 0
+
+    def _fit(self, key):
+        """Return coefficients of log-log fit for key, None if too few \
+searches. Timeouts only bound their searches from below, so they are \
+fitted at their deadline or the fit's prediction, whichever is longer."""
+        records = self.records.get(key, [])
+        timeouts = self.timeouts.get(key, [])
+        if len(records) < self.min_fit:
+            return None
+        runs = records + timeouts
+        x = np.array([self._features(*e[:4]) for e in runs])
+        y = np.log([max(e[4], 1e-3) for e in runs])
+        censored = np.arange(len(runs)) >= len(records)
+        bounds = y[censored]
+        coefficients = np.linalg.lstsq(x[~censored], y[~censored],
+                                       rcond=-1)[0]
+        for i in range(self.fit_iterations if timeouts else 0):
+            y[censored] = np.maximum(bounds,
+                                     np.dot(x[censored], coefficients))
+            coefficients = np.linalg.lstsq(x, y, rcond=-1)[0]
+        return coefficients
+
+    def predict(self, key, ntaxa, npatterns, npartitions, threads):
+        """Return predicted seconds for search, None if no past searches"""
+        with self.lock:
+            coefficients = self.coefficients.get(key)
+            if coefficients is not None:
+                return float(np.exp(np.dot(self._features(
+                    ntaxa, npatterns, npartitions, threads), coefficients)))
+            if not self.records.get(key):
+                return None
+            rate = max([e[4] / (e[0] * e[1]) for e in
+                        self.records[key] + self.timeouts[key]])
+        return rate * ntaxa * npatterns
+
+    def deadline(self, key, ntaxa, npatterns, npartitions, threads):
+        """Return seconds after which to kill search, None if no limit"""
+        if not self.multiple:
+            return None
+        seconds = self.predict(key, ntaxa, npatterns, npartitions, threads)
+        if seconds is None:
+            return None
+        return max(seconds * self.multiple, self.min_deadline)
+
+    def _added(self, key):
+        """Refit, and write if save_interval searches are unsaved"""
+        self.coefficients[key] = self._fit(key)
+        self.unsaved += 1
+        if self.unsaved >= self.save_interval:
+            self._write()
+            self.unsaved = 0
+
+    def add(self, key, ntaxa, npatterns, npartitions, threads, seconds):
+        """Add a finished search"""
+        with self.lock:
+            records = self.records.setdefault(key, [])
+            self.timeouts.setdefault(key, [])
+            records.append((ntaxa, npatterns, npartitions, threads, seconds))
+            del records[:-self.max_records]
+            self._added(key)
+
+    def timeout(self, key, ntaxa, npatterns, npartitions, threads, deadline):
+        """Record a search killed at deadline"""
+        self.logger.info('........ search killed after [{0:.0f}] seconds'.
+                         format(deadline))
+        with self.lock:
+            self.records.setdefault(key, [])
+            timeouts = self.timeouts.setdefault(key, [])
+            timeouts.append((ntaxa, npatterns, npartitions, threads,
+                             deadline, time.time()))
+            del timeouts[:-self.max_records]
+            self._added(key)
+
+
+class ConstraintTree(object):
+    """Constraint tree class : taxon tree parsed once, pruned to the tips \
+of an alignment in a single pass. The pruned Newick string, whether it is \
+bifurcating and its root to tip distances are cached by tip set."""
+    cache_size = 64
+
+    def __init__(self, path):
+        with open(path, "r") as file:
+            tree = Phylo.read(file, "newick")
+        # flatten tree: nodes in preorder, root is 0
+        self.names = []
+        self.lengths = []
+        self.children = []
+        stack = [(tree.root, None)]
+        while stack:
+            clade, parent = stack.pop()
+            node = len(self.names)
+            self.names.append(clade.name)
+            self.lengths.append(clade.branch_length)
+            self.children.append([])
+            if parent is not None:
+                self.children[parent].append(node)
+            stack.extend([(e, node) for e in reversed(clade.clades)])
+        # bitset of the tips below each node
+        self.tips = {}
+        self.masks = [0] * len(self.names)
+        for node in reversed(range(len(self.names))):
+            if self.children[node]:
+                for child in self.children[node]:
+                    self.masks[node] |= self.masks[child]
+            elif self.names[node]:
+                bit = self.tips.setdefault(self.names[node], len(self.tips))
+                self.masks[node] = 1 << bit
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _mask(self, tips):
+        mask = 0
+        for tip in tips:
+            if tip in self.tips:
+                mask |= 1 << self.tips[tip]
+        return mask
+
+    def _kept(self, node, mask):
+        return [e for e in self.children[node] if self.masks[e] & mask]
+
+    def _label(self, node, length):
+        label = self.names[node] if self.names[node] else ''
+        return label + ':{0:1.5f}'.format(length or 0.0)
+
+    def _newick(self, node, mask, depth, distances, bifurcating):
+        # collapse nodes left with a single child, summing branch lengths
+        length = self.lengths[node]
+        kept = self._kept(node, mask)
+        while len(kept) == 1:
+            node = kept[0]
+            if self.lengths[node] is not None:
+                length = (length or 0.0) + self.lengths[node]
+                depth += self.lengths[node]
+            kept = self._kept(node, mask)
+        if not kept:
+            distances[self.names[node]] = depth
+            return self._label(node, length)
+        if len(kept) != 2:
+            bifurcating[0] = False
+        subtrees = [self._newick(e, mask, depth + (self.lengths[e] or 0.0),
+                                 distances, bifurcating) for e in kept]
+        return '(' + ','.join(subtrees) + ')' + self._label(node, length)
+
+    def cached(self, tips):
+        """Return cached (newick, bifurcating, distances) for tips or None"""
+        mask = self._mask(tips)
+        with self.lock:
+            return self.cache.get(mask)
+
+    def prune(self, tips):
+        """Return (newick, bifurcating, distances) of tree pruned to tips"""
+        mask = self._mask(tips)
+        with self.lock:
+            if mask in self.cache:
+                res = self.cache.pop(mask)
+                self.cache[mask] = res
+                return res
+        # move the root up while it has a single child (its length is lost)
+        node = 0
+        length = self.lengths[node]
+        kept = self._kept(node, mask)
+        while len(kept) == 1 and self.children[kept[0]]:
+            node = kept[0]
+            length = None
+            kept = self._kept(node, mask)
+        distances = {}
+        # the root may be trifurcating
+        bifurcating = [len(kept) in (2, 3)]
+        subtrees = [self._newick(e, mask, self.lengths[e] or 0.0, distances,
+                                 bifurcating) for e in kept]
+        newick = '(' + ','.join(subtrees) + ')' + self._label(node, length) \
+            + ';'
+        res = (newick, bifurcating[0], distances)
+        with self.lock:
+            self.cache[mask] = res
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return res
 
 
 class Generator(object):
     """Phylogeny generating class"""
+    supermatrix_cache_size = 8
+    prescreen_audit = 0.1  # fraction of prescreen rejects searched anyway
+    draw_file = 'draw.p'
+    pid_file = 'RAxML.pid'  # written by RAxML() while it searches
+    checkpoint_after = 300.0  # predicted seconds to checkpoint a search
+
     def __init__(self, alignment_store, rttstat, outdir, maxtrys, logger,
                  wd=os.getcwd()):
         self.logger = logger
@@ -134,30 +785,32 @@ class Generator(object):
         self.phylogenies = []
         self.maxtrys = maxtrys
         self.alignment_store = alignment_store
+        self.supermatrices = OrderedDict()
+        self.backend = RAxMLBackend()
+        self.lock = threading.Lock()
         self.genes = alignment_store.keys()
         self.rttstat = rttstat
         self.outdir = outdir
         self.taxontree = os.path.join(outdir, "taxontree.tre")
         self.constraint = os.path.isfile(self.taxontree)
+        self.constraint_tree = None  # parsed on first use
+        self.prescreen = 0  # times rttstat for NJ trees of draws to pass
+        self.starts = 0  # fraction of searches from an NJ tree
+        self.runtimes = None  # RuntimeModel, to kill overlong searches
+        self.ntimeouts = 0
+        self.batch = 1  # searches per draw, in one run
+        self.batched = []  # passed trees of the last batch not yet returned
+        self.checkpoints = None  # directory for resumable searches
+        self.pipes = PipeSet()  # of running searches
+        self.resumable = []  # (directory, draw) of interrupted searches
+        self.prescreened = {'screened': 0, 'rejected': 0, 'audited': 0,
+                            'false_rejects': 0}
 
     def _test(self, phylogeny):
         """Return phylogeny if RTT stat is below max RTT stat"""
         if phylogeny:
             # remove outgroup, reduces RTT variance
-            try:
-                phylogeny.prune('outgroup')
-            except:
-                pass
-            # calc root to tip distance (rtt.dist) for each tip
-            rtt_dists = []
-            for terminal in phylogeny.get_terminals():
-                rtt_dists.append(phylogeny.distance(terminal))
-            # calculate CoV
-            mean = sum(rtt_dists)/len(rtt_dists)
-            sd = sqrt(sum([(e-mean)**2 for e in rtt_dists]) /
-                      len(rtt_dists))
-            rttstat = sd/mean  # CoV
-            # Phylo.draw_ascii(phylogeny)
+            rttstat, _ = rttStat(phylogeny, outgroup='outgroup')
             self.logger.debug('..... [{0}] RTT stat'.format(rttstat))
             if rttstat < self.rttstat:
                 return phylogeny
@@ -166,71 +819,118 @@ class Generator(object):
         else:
             self.logger.debug('.... no phylogeny, retrying')
 
+    def _prescreen(self, alignments, frames):
+        """Return True if the neighbour-joining tree of alignments passes \
+the RTT test at prescreen times rttstat"""
+        alignment = self._supermatrix(alignments, frames)[0]
+        if len(alignment) < 3:
+            return True
+        newick = neighbourJoining(alignment.ids, distanceMatrix(alignment))
+        phylogeny = Phylo.read(StringIO(newick), 'newick')
+        if 'outgroup' in alignment.index:
+            phylogeny.root_with_outgroup('outgroup')
+        else:
+            phylogeny.root_at_midpoint()
+        rttstat, _ = rttStat(phylogeny, outgroup='outgroup')
+        self.logger.debug('..... [{0}] NJ RTT stat'.format(rttstat))
+        return rttstat < self.rttstat * self.prescreen
+
+    def _supermatrix(self, alignments, frames):
+        """Return supermatrix of alignments, reframed if they have a reading
+frame, and its partition text (None for a single unpartitioned alignment).
+Supermatrices of the last few combinations of alignment files are cached."""
+        alignments = [asArray(e) for e in alignments]
+        key = tuple([(e.path, frame) for e, frame in zip(alignments, frames)])
+        if None in [e.path for e in alignments]:
+            key = None
+        with self.lock:
+            if key in self.supermatrices:
+                return self.supermatrices[key]
+        reframed = [e if frame is None else e.frame(frame) for e, frame in
+                    zip(alignments, frames)]
+        if len(reframed) == 1:
+            supermatrix = reframed[0]
+            text = None
+            if frames[0] is not None:
+                text = partitionText(1, 1, supermatrix.get_alignment_length(),
+                                     codon=True)
+        else:
+            # index IDs, keeping order of first appearance
+            all_ids = []
+            index = {}
+            for alignment in reframed:
+                for txid in alignment.ids:
+                    if txid not in index:
+                        index[txid] = len(all_ids)
+                        all_ids.append(txid)
+            # fill gene blocks of gapped matrix, writing partitions
+            width = sum([e.get_alignment_length() for e in reframed])
+            matrix = np.empty((len(all_ids), width), dtype=np.uint8)
+            matrix.fill(ord('-'))
+            begin = 0
+            text = ''
+            for ngene, alignment in enumerate(reframed):
+                end = begin + alignment.get_alignment_length()
+                rows = [index[e] for e in alignment.ids]
+                matrix[rows, begin:end] = alignment.matrix
+                text += partitionText(ngene + 1, begin + 1, end,
+                                      codon=frames[ngene] is not None)
+                begin = end
+            supermatrix = ArrayAlignment(
+                all_ids, matrix, ["multigene sequence"] * len(all_ids))
+        if key:
+            with self.lock:
+                self.supermatrices[key] = (supermatrix, text)
+                while len(self.supermatrices) > self.supermatrix_cache_size:
+                    self.supermatrices.popitem(last=False)
+        return supermatrix, text
+
     def _concatenate(self, alignments):
         """Return single alignment from list of alignments for
 multiple genes."""
-        if len(alignments) == 1:
-            return alignments[0]
-        # sort IDs
-        alignment_ids = []
-        for gene in alignments:
-            gene_ids = []
-            for rec in gene:
-                gene_ids.append(rec.id)
-            alignment_ids.append(gene_ids)
-        all_ids = []
-        [all_ids.extend(e) for e in alignment_ids]
-        all_ids = list(set(all_ids))
-        # concatenate
-        alignment = MultipleSeqAlignment([])
-        for txid in all_ids:
-            sequence = ""
-            for i, gene in enumerate(alignments):
-                if txid in alignment_ids[i]:
-                    sequence += gene[alignment_ids[i].index(txid)].seq
-                else:
-                    sequence += "-" * gene.get_alignment_length()
-            sequence = SeqRecord(sequence, id=txid,
-                                 description="multigene sequence")
-            alignment.append(sequence)
-        return alignment
+        return self._supermatrix(alignments, [None] * len(alignments))[0]
 
-    def _constraint(self, alignment):
+    def _constraint(self, alignment, wd=None):
         """Generate constraint tree using taxontree, return arg"""
+        wd = wd if wd else self.wd
         if not self.constraint:
             return False
         # drop tips from taxontree if not in alignment
-        tip_names = []
-        for record in alignment:
-            tip_names.append(record.id)
-        with open(self.taxontree, "r") as file:
-            constraint = Phylo.read(file, "newick")
-        constraint_tips = []
-        for terminal in constraint.get_terminals():
-            constraint_tips.append(terminal.name)
-        tips_to_drop = [e for e in constraint_tips if e not in tip_names]
-        for tip in tips_to_drop:
-            constraint.prune(tip)
+        if self.constraint_tree is None:
+            with self.lock:
+                if self.constraint_tree is None:
+                    self.constraint_tree = ConstraintTree(self.taxontree)
+        newick, bifurcating, _ = self.constraint_tree.prune(
+            [e.id for e in alignment])
         # write out tree
-        with open(os.path.join(self.wd, "constraint.tre"), "w") as file:
-            Phylo.write(constraint, file, "newick")
+        with open(os.path.join(wd, "constraint.tre"), "w") as file:
+            file.write(newick + '\n')
         # return arg
-        if constraint.is_bifurcating():
+        if bifurcating:
             return " -r constraint.tre"
         else:
             return " -g constraint.tre"
 
-    def _outgroup(self, alignment):
+    def _outgroup(self, alignment, wd=None):
         """Return arg for outgroup"""
+        wd = wd if wd else self.wd
         spp = [e.id for e in alignment]
         if 'outgroup' in spp:
             return 'outgroup'
         # otherwise find the species(s) with the fewest shared
         #  taxonomic groups
         if self.constraint:
-            with open(os.path.join(self.wd, "constraint.tre"), "r") as file:
-                constraint = Phylo.read(file, "newick")
-            distances = [constraint.distance(e) for e in spp]
+            cached = None
+            if self.constraint_tree is not None:
+                cached = self.constraint_tree.cached(spp)
+            if cached:
+                distances = cached[2]
+            else:
+                # constraint.tre not written by _constraint
+                with open(os.path.join(wd, "constraint.tre"), "r") as file:
+                    constraint = Phylo.read(file, "newick")
+                distances = dict(rootToTip(constraint))
+            distances = [distances[e] for e in spp]
             index = [i for i, e in enumerate(distances) if e ==
                      min(distances)]
             # choose one at random
@@ -241,118 +941,729 @@ multiple genes."""
 
     def _findORF(self, alignment, stop):
         """Return ORF of alignment based on absence of stop codons"""
-        # TODO: too complex, consider breaking up
-        def reframe(alignment, frame):
-            # return alignment from point where frame starts
-            alignment = alignment[:, frame:]
-            offset = alignment.get_alignment_length() % 3
-            if offset > 0:
-                alignment = alignment[:, :-offset]
-            return alignment
-        if not stop:
+        alignment = asArray(alignment)
+        frame = findFrame(alignment, stop)
+        if frame is None:
             return alignment, False
-        # Unpack stop patterns
-        fstop, rstop = stop
-        frame_stops = [0, 0, 0, 0, 0, 0]
-        for record in alignment:
-            # convert to string
-            seq = str(record.seq)
-            # search for stop codons ignoring last 50bps; expect
-            #  a stop codon at the end of a sequence
-            frame_stops[0] += sum([bool(fstop.match(seq[:-50]
-                                  [e:e + 3])) for e in range(0, len(seq), 3)])
-            frame_stops[1] += sum([bool(fstop.match(seq[:-50]
-                                  [e:e + 3])) for e in range(1, len(seq), 3)])
-            frame_stops[2] += sum([bool(fstop.match(seq[:-50]
-                                  [e:e + 3])) for e in range(2, len(seq), 3)])
-            frame_stops[3] += sum([bool(rstop.match(seq[50:]
-                                  [e:e + 3])) for e in range(0, len(seq), 3)])
-            frame_stops[4] += sum([bool(rstop.match(seq[50:]
-                                  [e:e + 3])) for e in range(1, len(seq), 3)])
-            frame_stops[5] += sum([bool(rstop.match(seq[50:]
-                                  [e:e + 3])) for e in range(2, len(seq), 3)])
-        # if more than one frame wo stop codon
-        #  return wo codon partitions
-        if sum([e == 0 for e in frame_stops]) > 1:
-            return alignment, False
-        # if no frames wo stop codons, return wo codon partitions
-        if sum([e == 0 for e in frame_stops]) == 0:
-            return alignment, False
-        # else return frame and reframed alignment
-        if frame_stops[0] == 0 or frame_stops[3] == 0:
-            return reframe(alignment, 0), True
-        if frame_stops[1] == 0 or frame_stops[4] == 0:
-            return reframe(alignment, 1), True
-        if frame_stops[2] == 0 or frame_stops[5] == 0:
-            return reframe(alignment, 2), True
-
-    def _partition(self, alignments, stops):
+        return alignment.frame(frame), True
+
+    def _partition(self, alignments, frames):
         """Return partition argument, write out partition postitions
 to partitions.txt"""
+        alignments = [asArray(e) for e in alignments]
         if len(alignments) == 1:
-            if not stops[0]:
+            if frames[0] is None:
                 return alignments, None
         begin = 1
-        ngene = 1
         text = ''
         reframed = []
-        for alignment, stop in zip(alignments, stops):
-            # if stop pattern gets ORF, partition by codon ...
-            alignment, partitioned = self._findORF(alignment, stop)
-            if partitioned:
-                end = alignment.get_alignment_length() + begin - 1
-                text += 'DNA, gene{0}codon1 = {1}-{2}\\3\n'.\
-                    format(ngene, begin, end)
-                text += 'DNA, gene{0}codon2 = {1}-{2}\\3\n'.\
-                    format(ngene, begin + 1, end)
-                text += 'DNA, gene{0}codon3 = {1}-{2}\\3\n'.\
-                    format(ngene, begin + 2, end)
-            else:
-                # ... else just for the whole gene
-                end = alignment.get_alignment_length() + begin - 1
-                text += 'DNA, gene{0} = {1}-{2}\n'.\
-                    format(ngene, begin, end)
+        for ngene, (alignment, frame) in enumerate(zip(alignments, frames)):
+            # if alignment has an ORF, partition by codon ...
+            #  ... else just for the whole gene
+            if frame is not None:
+                alignment = alignment.frame(frame)
+            end = alignment.get_alignment_length() + begin - 1
+            text += partitionText(ngene + 1, begin, end,
+                                  codon=frame is not None)
             begin = end + 1
-            ngene += 1
             reframed.append(alignment)
         logging.debug([e.get_alignment_length() for e in alignments])
         logging.debug(text)
-        with open(os.path.join(self.wd, 'partitions.txt'), 'w') as file:
+        return reframed, self._writePartitions(text)
+
+    def _writePartitions(self, text, wd=None):
+        """Write partition text to partitions.txt, return partition arg"""
+        wd = wd if wd else self.wd
+        if not text:
+            return None
+        with open(os.path.join(wd, 'partitions.txt'), 'w') as file:
             file.write(text)
-        return reframed, ' -q partitions.txt'
-
-    def _setUp(self, alignments, stops):
-        """Set up for RAxML"""
-        # partition
-        alignments, parg = self._partition(alignments, stops)
-        # create supermatrix alignment
-        alignment = self._concatenate(alignments)
+        return ' -q partitions.txt'
+
+    def _start(self, alignment, constraint, wd=None):
+        """Write neighbour-joining starting tree to start.tre for a starts \
+fraction of searches, return arg. Constrained searches only get one if \
+the backend takes a starting tree with a constraint, built within the \
+constraint's clades."""
+        wd = wd if wd else self.wd
+        if not self.starts or len(alignment) < 4:
+            return None
+        if constraint and not self.backend.constrained_starts:
+            return None
+        if random.random() >= self.starts:
+            return None
+        if constraint:
+            with open(os.path.join(wd, 'constraint.tre'), 'r') as file:
+                constraint = file.read().strip()
+        newick = neighbourJoining(alignment.ids, distanceMatrix(alignment),
+                                  constraint)
+        with open(os.path.join(wd, 'start.tre'), 'w') as file:
+            file.write(newick + '\n')
+        return ' -t start.tre'
+
+    def _setUp(self, alignments, frames, wd=None):
+        """Set up for RAxML in wd, return supermatrix, args and its runtime \
+key, numbers of taxa, patterns and partitions (None unless runtimes are \
+modelled)"""
+        # create partitioned supermatrix alignment
+        alignment, text = self._supermatrix(alignments, frames)
+        parg = self._writePartitions(text, wd)
         # create constraint
-        carg = self._constraint(alignment)
+        carg = self._constraint(alignment, wd)
         # get outgroup arg
-        outgroup = self._outgroup(alignment)
-        return alignment, carg, outgroup, parg
+        outgroup = self._outgroup(alignment, wd)
+        size = None
+        if self.runtimes:
+            size = (self.backend.key(alignment), len(alignment),
+                    countPatterns(alignment), text.count('\n') if text else 1)
+        return alignment, carg, outgroup, parg, size
+
+    def _checkpoint(self, alignments, frames):
+        """Return new persistent directory for a search in checkpoints, \
+recording its draw so an interrupted run can resume it"""
+        wd = tempfile.mkdtemp(prefix='tree_', dir=self.checkpoints)
+        draw = {'alignments': [e.path if getattr(e, 'path', None) else e
+                               for e in alignments],
+                'frames': frames, 'constraint': self.constraint}
+        with open(os.path.join(wd, self.draw_file), 'wb') as file:
+            pickle.dump(draw, file)
+        return wd
+
+    def _running(self, wd):
+        """Return True if the process in pid_file of wd is alive"""
+        try:
+            with open(os.path.join(wd, self.pid_file), 'r') as file:
+                pid = int(file.read())
+        except (IOError, ValueError):
+            return False
+        try:
+            os.kill(pid, 0)
+        except OSError as error:
+            # EPERM: alive, but not ours to signal
+            return error.errno == errno.EPERM
+        return True
+
+    def resume(self):
+        """Queue searches left in checkpoints by an interrupted run (of \
+the same constraint) to be run again before new draws are made. Return \
+number queued."""
+        self.resumable = []
+        if not self.checkpoints or not os.path.isdir(self.checkpoints):
+            return 0
+        for each in sorted(os.listdir(self.checkpoints)):
+            wd = os.path.join(self.checkpoints, each)
+            try:
+                with open(os.path.join(wd, self.draw_file), 'rb') as file:
+                    draw = pickle.load(file)
+            except (IOError, EOFError, pickle.UnpicklingError):
+                # interrupted before the draw was recorded
+                shutil.rmtree(wd, ignore_errors=True)
+                continue
+            if self._running(wd):
+                # orphaned by a killed run, a second RAxML would clash
+                self.logger.info("........ [{0}] is still being searched, \
+not resumed".format(each))
+                continue
+            if draw['constraint'] == self.constraint:
+                self.resumable.append((wd, draw))
+        return len(self.resumable)
+
+    def _search(self, alignments, frames, threads, ntrees=1, wd=None):
+        """Return phylogeny of alignments from backend, set up and run in \
+its own scratch directory, or in persistent wd (removed once the search is \
+done). If ntrees is more than 1, return list of phylogenies \
+of ntrees searches in one run."""
+        if wd is None:
+            with ScratchSpace(self.wd, prefix='search_',
+                              use_tmpfs=False) as scratch:
+                return self._infer(alignments, frames, threads, ntrees,
+                                   scratch)
+        # not removed if interrupted, so it can be resumed
+        phylogeny = self._infer(alignments, frames, threads, ntrees, wd,
+                                checkpoint=True)
+        if not self.pipes.closed:
+            shutil.rmtree(wd, ignore_errors=True)
+        return phylogeny
+
+    def _infer(self, alignments, frames, threads, ntrees, wd,
+               checkpoint=False):
+        """Set up and run backend in wd, return phylogeny (or list)"""
+        # set up
+        alignment, carg, outgroup, parg, size = self._setUp(alignments,
+                                                            frames, wd)
+        sarg = self._start(alignment, carg, wd) if ntrees == 1 else None
+        deadline = None
+        if self.runtimes:
+            size += (threads,)
+            deadline = self.runtimes.deadline(*size)
+            if deadline:
+                deadline *= ntrees
+        if checkpoint and self.runtimes:
+            # quick searches are cheaper to redo than to checkpoint
+            predicted = self.runtimes.predict(*size)
+            if predicted is not None and predicted < self.checkpoint_after:
+                checkpoint = False
+        # run tree inference
+        start = time.time()
+        if ntrees > 1:
+            phylogeny = self.backend.searches(
+                alignment, wd=wd, logger=self.logger, threads=threads,
+                ntrees=ntrees, constraint=carg, outgroup=outgroup,
+                partitions=parg, timeout=deadline, pipes=self.pipes)
+        else:
+            phylogeny = self.backend.search(
+                alignment, wd=wd, logger=self.logger, threads=threads,
+                constraint=carg, outgroup=outgroup, partitions=parg,
+                start=sarg, timeout=deadline, checkpoint=checkpoint,
+                pipes=self.pipes)
+        seconds = time.time() - start
+        if self.runtimes:
+            # batches share set up, so only single searches are modelled
+            if phylogeny and ntrees == 1:
+                self.runtimes.add(*(size + (seconds,)))
+            elif not phylogeny and deadline and seconds >= deadline:
+                if ntrees == 1:
+                    self.runtimes.timeout(*(size + (deadline,)))
+                with self.lock:
+                    self.ntimeouts += 1
+        return phylogeny
+
+    def generate(self):
+        """Return phylogeny from a random draw of alignments if it passes \
+the RTT test, else None. Each call sets up and runs RAxML in its own \
+scratch directory, so calls can be made from several threads at once."""
+        with self.lock:
+            if self.batched:
+                return self.batched.pop(0)
+            if self.trys > self.maxtrys:
+                raise RAxMLError()
+            resumed = self.resumable.pop(0) if self.resumable else None
+            if not resumed:
+                # choose random alignment for each gene
+                alignments, frames = self.alignment_store.pull()
+        wd = None
+        if resumed:
+            wd, draw = resumed
+            self.logger.info("........ Resuming search of [{0}]".
+                             format(os.path.basename(wd)))
+            alignments = [readFastaFile(e) if isinstance(e, basestring)
+                          else e for e in draw['alignments']]
+            frames = draw['frames']
+        screened = True
+        if self.prescreen and not resumed:
+            screened = self._prescreen(alignments, frames)
+            audit = not screened and random.random() < self.prescreen_audit
+            with self.lock:
+                self.prescreened['screened'] += 1
+                self.prescreened['rejected'] += not screened
+                self.prescreened['audited'] += audit
+            if not screened and not audit:
+                self.logger.info('........ poor NJ phylogeny, retrying')
+                self.alignment_store.count(alignments, False)
+                with self.lock:
+                    self.trys += 1
+                return None
+        # RAxML only resumes unconstrained searches
+        if not wd and self.checkpoints and self.backend.checkpoints and \
+                self.batch == 1 and not self.constraint:
+            wd = self._checkpoint(alignments, frames)
+        if self.batch > 1:
+            phylogenies = self._search(alignments, frames, self.threads,
+                                       self.batch)
+        else:
+            phylogenies = [self._search(alignments, frames, self.threads,
+                                        wd=wd)]
+        if self.pipes.closed:
+            # killed, not the alignments' fault
+            return None
+        phylogenies = [self._test(e) for e in phylogenies] if phylogenies \
+            else [None]
+        for phylogeny in phylogenies:
+            self.alignment_store.count(alignments, phylogeny is not None)
+        phylogenies = [e for e in phylogenies if e]
+        with self.lock:
+            if not screened and phylogenies:
+                self.prescreened['false_rejects'] += 1
+            if phylogenies:
+                self.phylogenies.extend(phylogenies)
+                self.batched.extend(phylogenies[1:])
+                self.trys = 0
+            else:
+                self.trys += 1
+        return phylogenies[0] if phylogenies else None
+
+    def keep(self, alignments, phylogenies):
+        """Test and count phylogenies of alignments searched outside \
+generate(), those that pass are returned by the next calls"""
+        phylogenies = [self._test(e) for e in phylogenies]
+        for phylogeny in phylogenies:
+            self.alignment_store.count(alignments, phylogeny is not None)
+        phylogenies = [e for e in phylogenies if e]
+        with self.lock:
+            self.phylogenies.extend(phylogenies)
+            self.batched.extend(phylogenies)
 
     def run(self):
         """Generate phylogeny from alignments"""
-        if self.trys > self.maxtrys:
-            raise RAxMLError()
-        # choose random alignment for each gene
-        alignments, stops = self.alignment_store.pull()
-        # set up
-        alignment, carg, outgroup, parg = self._setUp(alignments, stops)
-        # run RAxML
-        phylogeny = RAxML(alignment, wd=self.wd, logger=self.logger,
-                          threads=self.threads, constraint=carg,
-                          outgroup=outgroup, partitions=parg)
-        phylogeny = self._test(phylogeny)
-        if phylogeny:
-            self.phylogenies.append(phylogeny)
-            self.trys = 0
-            return True
+        return self.generate() is not None
+
+
+class SplitCounter(object):
+    """Split counting class : Newick trees are added one at a time, their \
+clades encoded as integer bitsets over a taxon index and counted, with \
+summed branch lengths. The majority-rule consensus can be built from the \
+counts at any point. If taxa are given, the index is fixed and other tips \
+are dropped from trees as they are added. Otherwise the clades of each \
+tree are kept, so that trees with differing taxa can be counted pruned to \
+the taxa common to all trees, for the consensus. This costs about 32 bytes \
+per taxon per tree (the bitsets are shared with the counts), so memory \
+grows with the number of trees. Alternate trees are also counted in two \
+halves, to measure convergence."""
+
+    def __init__(self, taxa=None):
+        self.fixed = taxa is not None
+        self.taxa = list(taxa) if taxa else []
+        self.index = dict([(e, i) for i, e in enumerate(self.taxa)])
+        self.ntrees = 0
+        self.counts = Counter()
+        self.lengths = Counter()
+        self.nlengths = Counter()
+        self.common = None  # bitset of taxa in all trees
+        self.tipsets = set()
+        self.halves = (Counter(), Counter())
+        self.nhalves = [0, 0]
+        # (clades, lengths) of each tree, if not fixed: the common taxa can
+        #  shrink with any tree, and pruning a tree needs all its clades
+        self.trees = []
+        self.bitsets = {}  # one copy of each clade bitset, shared by trees
+        self.pruned = None  # counts of trees pruned to common taxa
+
+    def _tip(self, name):
+        if name not in self.index:
+            if self.fixed:
+                return 0
+            self.index[name] = len(self.taxa)
+            self.taxa.append(name)
+        return 1 << self.index[name]
+
+    def _merge(self, nodes, mask=None):
+        """Return dict of clade bitset: branch length of nodes (pairs of \
+bitset and length), pruned to taxa in mask if given. Pruned nodes are \
+merged with the node they collapse into."""
+        clades = {}
+        for bitset, length in nodes:
+            if mask is not None:
+                bitset &= mask
+            if not bitset:
+                continue
+            if clades.get(bitset) is not None:
+                if length is not None:
+                    clades[bitset] += length
+            else:
+                clades[bitset] = length
+        return clades
+
+    def _count(self, clades):
+        """Count clades of a tree"""
+        tipset = max(clades)
+        half = self.ntrees % 2
+        for bitset, length in clades.iteritems():
+            self.counts[bitset] += 1
+            self.halves[half][bitset] += 1
+            if length is not None:
+                self.lengths[bitset] += length
+                self.nlengths[bitset] += 1
+        self.ntrees += 1
+        self.nhalves[half] += 1
+        self.tipsets.add(tipset)
+        self.common = tipset if self.common is None else self.common & tipset
+
+    def _prune(self):
+        """Return counter of trees pruned to common taxa, from the kept \
+clades of each tree"""
+        pruned = SplitCounter(taxa=self.taxa)
+        for clades, lengths in self.trees:
+            pruned._count(self._merge(
+                zip(clades, [None if e != e else e for e in lengths]),
+                self.common))
+        return pruned
+
+    def add(self, newick):
+        """Count clades of tree in Newick string"""
+        nodes = []  # [bitset, branch length] of each node
+        stack = [[0, None]]
+        last = None
+        closed = False
+        for token in _newick_tokens.findall(newick):
+            if token == '(':
+                stack.append([0, None])
+                closed = False
+            elif token == ')':
+                last = stack.pop()
+                stack[-1][0] |= last[0]
+                nodes.append(last)
+                closed = True
+            elif token == ',':
+                closed = False
+            elif token.startswith(':'):
+                if last is not None:
+                    last[1] = float(token[1:])
+            elif token == ';':
+                break
+            elif not token.startswith('[') and not closed:
+                if token.startswith("'"):
+                    token = token[1:-1].replace("''", "'")
+                last = [self._tip(token), None]
+                stack[-1][0] |= last[0]
+                nodes.append(last)
+        clades = self._merge(nodes)
+        if not clades:
+            return
+        common = self.common
+        self._count(clades)
+        if self.fixed:
+            return
+        bitsets = tuple([self.bitsets.setdefault(e, e) for e in clades])
+        self.trees.append((bitsets, array.array(
+            'd', [float('nan') if clades[e] is None else clades[e] for e in
+                  bitsets])))
+        if self.pruned is not None and self.common == common:
+            # keep pruned counts in step
+            self.pruned._count(self._merge(clades.iteritems(), self.common))
         else:
-            self.trys += 1
-            return False
+            # common taxa changed, prune again when needed
+            self.pruned = None
+
+    def read(self, path):
+        """Count clades of all trees in Newick file at path"""
+        if os.path.isfile(path):
+            with open(path, 'r') as file:
+                for newick in iterNewick(file):
+                    self.add(newick)
+
+    def uniform(self):
+        """Return True if all trees have the same taxa"""
+        return len(self.tipsets) < 2
+
+    def commonTaxa(self):
+        """Return taxa present in all trees"""
+        if self.common is None:
+            return []
+        return [e for i, e in enumerate(self.taxa) if self.common >> i & 1]
+
+    def asdsf(self, min_freq=0.1):
+        """Return average standard deviation of split frequencies between \
+the two halves of trees (pruned to the taxa in all trees), over \
+non-trivial clades with a frequency of at least min_freq in either half"""
+        if not all(self.nhalves):
+            return None
+        if not self.uniform() and not self.fixed:
+            # else taxon sampling alone makes the halves differ
+            if self.pruned is None:
+                self.pruned = self._prune()
+            return self.pruned.asdsf(min_freq)
+        sds = []
+        for bitset in self.counts:
+            if bitset in self.tipsets or not bitset & (bitset - 1):
+                # all taxa or a single tip
+                continue
+            freqs = [float(half[bitset]) / n for half, n in
+                     zip(self.halves, self.nhalves)]
+            if max(freqs) >= min_freq:
+                # sample standard deviation of two values
+                sds.append(abs(freqs[0] - freqs[1]) / np.sqrt(2))
+        if not sds:
+            return 0.0
+        return sum(sds) / len(sds)
+
+    def consensus(self, min_freq=0.5, is_rooted=True):
+        """Return majority-rule consensus of trees (pruned to the taxa in \
+all trees) as a Newick string, support as node labels and mean branch \
+lengths"""
+        if not self.ntrees:
+            return None
+        if not self.uniform() and not self.fixed:
+            if self.pruned is None:
+                self.pruned = self._prune()
+            return self.pruned.consensus(min_freq, is_rooted)
+        full = self.common
+        counts = self.counts
+        if not is_rooted:
+            # splits of unrooted trees, as the side without the first taxon
+            counts = Counter()
+            for bitset, count in self.counts.iteritems():
+                if bitset & 1 and bitset != 1:
+                    bitset = full ^ bitset
+                if bitset and bitset != full ^ 1:
+                    counts[bitset] += count
+            counts[full] = self.ntrees
+        splits = []
+        for bitset, count in counts.iteritems():
+            freq = float(count) / self.ntrees
+            if freq >= min_freq or (abs(min_freq - 1.0) <= 1e-7 and
+                                    abs(freq - 1.0) <= 1e-7):
+                splits.append((freq, bitset))
+        splits.sort(reverse=True)
+        # add most frequent compatible clades, nested or disjoint
+        accepted = []
+        for freq, bitset in splits:
+            for other in accepted:
+                overlap = bitset & other
+                if overlap and overlap != bitset and overlap != other:
+                    break
+            else:
+                accepted.append(bitset)
+        # attach each clade to the smallest accepted clade containing it
+        accepted.sort(key=lambda e: bin(e).count('1'), reverse=True)
+        children = dict([(e, []) for e in accepted])
+        for i, bitset in enumerate(accepted[1:]):
+            for parent in reversed(accepted[:i + 1]):
+                if bitset & parent == bitset:
+                    children[parent].append(bitset)
+                    break
+
+        def label(bitset):
+            if not children[bitset]:
+                text = self.taxa[bitset.bit_length() - 1]
+            else:
+                text = '{0:0.4f}'.format(round(float(counts[bitset]) /
+                                               self.ntrees, 4))
+            if bitset == full:
+                return text + ':0.0'
+            if self.nlengths[bitset]:
+                text += ':{0}'.format(self.lengths[bitset] /
+                                      self.nlengths[bitset])
+            return text
+
+        # write out without recursion, children in taxon order
+        parts = {}
+        stack = [(accepted[0], False)]
+        while stack:
+            bitset, visited = stack.pop()
+            if visited or not children[bitset]:
+                if children[bitset]:
+                    kids = sorted(children[bitset],
+                                  key=lambda e: e & -e)
+                    parts[bitset] = '(' + ','.join([parts.pop(e) for e in
+                                                    kids]) + ')' + \
+                        label(bitset)
+                else:
+                    parts[bitset] = label(bitset)
+            else:
+                stack.append((bitset, True))
+                stack.extend([(e, False) for e in children[bitset]])
+        newick = parts[accepted[0]] + ';'
+        return '[&R] ' + newick if is_rooted else newick
+
+
+def stopTable(pattern):
+    """Return boolean lookup table of the codon codes (see codonCodes) that \
+match stop pattern"""
+    key = (pattern.pattern, pattern.flags)
+    if key not in _stop_tables:
+        table = np.zeros(9 ** 3, dtype=bool)
+        letters = 'acgtACGT'
+        for i, j, k in itertools.product(range(8), repeat=3):
+            codon = letters[i] + letters[j] + letters[k]
+            table[i * 81 + j * 9 + k] = bool(pattern.match(codon))
+        _stop_tables[key] = table
+    return _stop_tables[key]
+
+
+def codonCodes(matrix, frame):
+    """Return code for each whole codon in frame of each row of matrix: \
+nucleotides are coded 0-7 (acgtACGT) and anything else 8, codons are \
+base-9 numbers"""
+    nrows, length = matrix.shape
+    ncodons = max(length - frame, 0) // 3
+    codons = _nuc_codes[matrix[:, frame:frame + ncodons * 3]].\
+        reshape(nrows, ncodons, 3)
+    return codons[:, :, 0] * 81 + codons[:, :, 1] * 9 + codons[:, :, 2]
+
+
+def findFrame(alignment, stop):
+    """Return reading frame (0, 1 or 2) of alignment if only one frame is \
+free of stop codons, else None"""
+    if not stop:
+        return None
+    fstop, rstop = [stopTable(e) for e in stop]
+    matrix = asArray(alignment).matrix
+    # search for stop codons ignoring last 50bps; expect
+    #  a stop codon at the end of a sequence
+    frame_stops = [fstop[codonCodes(matrix[:, :-50], e)].sum() for e in
+                   range(3)]
+    frame_stops += [rstop[codonCodes(matrix[:, 50:], e)].sum() for e in
+                    range(3)]
+    # if more than one or no frames wo stop codon
+    #  return wo codon partitions
+    if sum([e == 0 for e in frame_stops]) != 1:
+        return None
+    # else return frame
+    for frame in range(3):
+        if frame_stops[frame] == 0 or frame_stops[frame + 3] == 0:
+            return frame
+
+
+def partitionText(ngene, begin, end, codon=False):
+    """Return RAxML partition lines for gene from begin to end (1-based)"""
+    if codon:
+        return ''.join(['DNA, gene{0}codon{1} = {2}-{3}\\3\n'.
+                        format(ngene, i + 1, begin + i, end) for i in
+                        range(3)])
+    return 'DNA, gene{0} = {1}-{2}\n'.format(ngene, begin, end)
+
+
+def stopKey(stop):
+    """Return picklable key for stop patterns"""
+    if not stop:
+        return None
+    return tuple([e.pattern for e in stop])
+
+
+def rootToTip(phylogeny):
+    """Return (name, root to tip distance) of each tip of phylogeny, found \
+in a single traversal"""
+    distances = []
+    stack = [(phylogeny.root, 0.0)]
+    while stack:
+        clade, distance = stack.pop()
+        if clade.clades:
+            stack.extend([(e, distance + (e.branch_length or 0.0)) for e in
+                          reversed(clade.clades)])
+        else:
+            distances.append((clade.name, distance))
+    return distances
+
+
+def rttStat(phylogeny, outgroup=None):
+    """Return coefficient of variation of root to tip distances of \
+phylogeny, and the distances. If given, outgroup is first pruned from \
+phylogeny (in place) if present."""
+    if outgroup:
+        try:
+            phylogeny.prune(outgroup)
+        except ValueError:
+            pass
+    distances = rootToTip(phylogeny)
+    values = np.array([e[1] for e in distances])
+    mean = values.mean()
+    if mean == 0:
+        return float('inf'), distances
+    return values.std() / mean, distances
+
+
+def countPatterns(alignment):
+    """Return number of distinct site patterns (columns) in alignment"""
+    matrix = np.ascontiguousarray(asArray(alignment).matrix.T)
+    columns = matrix.view(np.dtype((np.void, matrix.shape[1])))
+    return len(np.unique(columns))
+
+
+def calcSearches(threads, raxml_threads):
+    """Return number of concurrent RAxML searches and threads per search \
+(including RAxML's master thread) for threads, given raxml_threads \
+threads per search (0 for all threads in one search)"""
+    if raxml_threads < 1 or raxml_threads >= threads:
+        return 1, threads + 1
+    return threads // raxml_threads, raxml_threads + 1
+
+
+def appendPhylogeny(phylogeny, outfile):
+    """Append phylogeny to outfile in a single write, return Newick string"""
+    handle = StringIO()
+    Phylo.write(phylogeny, handle, 'newick')
+    fd = os.open(outfile, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+    try:
+        os.write(fd, handle.getvalue())
+    finally:
+        os.close(fd)
+    return handle.getvalue()
+
+
+def isConverged(counter, asdsf, minphylos):
+    """Return True if counter has at least minphylos trees and the ASDSF \
+between its halves is below asdsf (never if asdsf is 0)"""
+    if not asdsf or counter is None or counter.ntrees < max(minphylos, 2):
+        return False
+    res = counter.asdsf()
+    return res is not None and res < asdsf
+
+
+def generatePhylogenies(generator, nphylos, outfile, nsearches, logger,
+                        counter=None, asdsf=0, minphylos=0):
+    """Generate nphylos phylogenies with generator, running nsearches \
+searches at once. Phylogenies are appended to outfile in the order their \
+searches started, and added to counter (a SplitCounter) if given. If asdsf \
+is given, stop early once counter has converged (see isConverged). Return \
+number of phylogenies written."""
+    if nphylos < 1 or isConverged(counter, asdsf, minphylos):
+        return 0
+    nsearches = max(1, min(nsearches, nphylos))
+    # searches are killed when we stop, as they are not in our process group
+    generator.pipes = PipeSet()
+    results = Queue.Queue()
+    tasks = iter(range(nphylos))
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    def worker():
+        while not stop.is_set():
+            with lock:
+                i = next(tasks, None)
+            if i is None:
+                return
+            try:
+                phylogeny = None
+                while phylogeny is None and not stop.is_set():
+                    phylogeny = generator.generate()
+            except Exception as error:
+                results.put((i, None, error))
+                return
+            results.put((i, phylogeny, None))
+
+    def terminate(signum, frame):
+        raise SystemExit('Terminated')
+
+    # SIGTERM would otherwise end us without killing the searches
+    main = threading.current_thread().name == 'MainThread'
+    if main:
+        handler = signal.signal(signal.SIGTERM, terminate)
+    workers = [threading.Thread(target=worker) for _ in range(nsearches)]
+    for each in workers:
+        each.daemon = True
+        each.start()
+    pending = {}
+    nwritten = 0
+    converged = False
+    try:
+        while nwritten < nphylos and not converged:
+            try:
+                i, phylogeny, error = results.get(timeout=1)
+            except Queue.Empty:
+                continue
+            if error:
+                raise error
+            pending[i] = phylogeny
+            while nwritten in pending and not converged:
+                newick = appendPhylogeny(pending.pop(nwritten), outfile)
+                if counter is not None:
+                    counter.add(newick)
+                nwritten += 1
+                logger.info(".... Iteration [{0}]".format(nwritten))
+                converged = isConverged(counter, asdsf, minphylos)
+                if converged:
+                    logger.info(".... converged, ASDSF [{0:.4f}]".format(
+                                counter.asdsf()))
+    finally:
+        stop.set()
+        generator.pipes.kill()
+        for each in workers:
+            each.join()
+        generator.pipes = PipeSet()
+        if main:
+            signal.signal(signal.SIGTERM, handler)
+    return nwritten
+
 
 def countNPhylos(nphylos, file):
     """Return number of nphylos still needed to be generated"""
@@ -366,90 +1677,508 @@ def countNPhylos(nphylos, file):
 
 
 def RAxML(alignment, wd, logger, threads, outgroup=None, partitions=None,
-          constraint=None, timeout=999999999):
+          constraint=None, timeout=None, start=None, ntrees=1,
+          checkpoint=False, pipes=None):
     """Adapted pG function: Generate phylogeny from alignment using
-RAxML (external program)."""
-    # TODO: too complex, consider breaking up
+RAxML (external program). If ntrees is more than 1, return list of the \
+phylogenies of ntrees searches from random starts in one run. If \
+checkpoint, RAxML is run in wd itself writing checkpoint trees and its pid \
+to RAxML.pid, and an unconstrained search resumes from the latest \
+checkpoint tree left there by an interrupted run."""
     input_file = 'phylogeny_in.phylip'
     output_file = 'phylogeny_out'
     file_line = ' -s ' + input_file + ' -n ' + output_file
     options = ' -p ' + str(random.randint(0, 10000000)) + ' -T ' + str(threads)
     if outgroup:
         options += ' -o ' + outgroup
-    with open(os.path.join(wd, input_file), "w") as file:
-        AlignIO.write(alignment, file, "phylip-relaxed")
-    # only use GTRCAT for more than 100 taxa (ref RAxML manual)
-    if len(alignment) > 100:
-        dnamodel = ' -m GTRCAT'
-    else:
-        dnamodel = ' -m GTRGAMMA'
+    dnamodel = raxmlModel(alignment)
     if partitions:
         options += partitions
     if constraint:
         options += constraint
+    if checkpoint:
+        if ntrees == 1:
+            # finished before the interrupted run could use it
+            try:
+                with open(os.path.join(wd, 'RAxML_bestTree.' + output_file),
+                          "r") as file:
+                    return Phylo.read(file, "newick")
+            except IOError:
+                pass
+        options += ' -j'
+        # RAxML does not take a starting tree with a constraint tree
+        if resumeRAxML(wd, output_file) and not constraint and ntrees == 1:
+            logger.debug('.... resuming from checkpoint')
+            start = ' -t resume.tre'
+    if start:
+        options += start
+    if ntrees > 1:
+        options += ' -N ' + str(ntrees)
     command_line = raxml + file_line + dnamodel + options
+    if checkpoint:
+        with open(os.path.join(wd, input_file), "w") as file:
+            asArray(alignment).write(file, "phylip-relaxed")
+        return runRAxML(command_line, wd, logger, timeout, output_file,
+                        ntrees, pidfile=os.path.join(wd, 'RAxML.pid'),
+                        pipes=pipes)
+    with ScratchSpace(wd) as scratch:
+        # move constraint and partition files written to wd into scratch
+        if constraint:
+            shutil.move(os.path.join(wd, 'constraint.tre'), scratch)
+        if partitions:
+            shutil.move(os.path.join(wd, 'partitions.txt'), scratch)
+        if start:
+            shutil.move(os.path.join(wd, 'start.tre'), scratch)
+        with open(os.path.join(scratch, input_file), "w") as file:
+            asArray(alignment).write(file, "phylip-relaxed")
+        return runRAxML(command_line, scratch, logger, timeout, output_file,
+                        ntrees, pipes=pipes)
+
+
+def raxmlModel(alignment):
+    """Return RAxML model arg for alignment"""
+    # only use GTRCAT for more than 100 taxa (ref RAxML manual)
+    if len(alignment) > 100:
+        return ' -m GTRCAT'
+    return ' -m GTRGAMMA'
+
+
+def runRAxML(command_line, wd, logger, timeout, output_file, ntrees=1,
+             pidfile=None, pipes=None):
+    """Run RAxML command line in wd, return phylogeny (or list of ntrees \
+phylogenies). RAxML's pid is kept in pidfile while it runs, its pipe in \
+pipes (a PipeSet)."""
     logger.debug(command_line)
-    pipe = TerminationPipe(command_line, silent=True, cwd=wd)
+    pipe = TerminationPipe(command_line, silent=True, cwd=wd,
+                           timeout=timeout if timeout else 999999999,
+                           pidfile=pidfile, pipes=pipes)
     pipe.run()
-    if not pipe.failure:
-        try:
-            with open(os.path.join(wd, 'RAxML_bestTree.' + output_file), "r") \
+    logger.debug('.... CPU time [{0}] max RSS [{1}]'.
+                 format(pipe.cputime, pipe.maxrss))
+    if pipe.failure:
+        # if pipe.failure, timeout, return no phylogeny
+        logger.debug('.... RAxML timeout ....')
+        return None if ntrees == 1 else []
+    if ntrees > 1:
+        trees = []
+        for i in range(ntrees):
+            try:
+                with open(os.path.join(wd, 'RAxML_result.{0}.RUN.{1}'.
+                                       format(output_file, i)), "r") as file:
+                    trees.append(Phylo.read(file, "newick"))
+            except IOError:
+                pass
+        return trees
+    try:
+        with open(os.path.join(wd, 'RAxML_bestTree.' + output_file),
+                  "r") as file:
+            return Phylo.read(file, "newick")
+    except IOError:
+        return None
+
+
+def resumeRAxML(wd, output_file):
+    """Copy latest RAxML checkpoint tree in wd to resume.tre, remove \
+RAxML output files (RAxML will not overwrite them). Return True if there \
+was a checkpoint tree."""
+    pattern = re.compile('^RAxML_checkpoint\.' + re.escape(output_file) +
+                         '\.([0-9]+)$')
+    checkpoints = []
+    for each in os.listdir(wd):
+        match = pattern.match(each)
+        if match:
+            checkpoints.append((int(match.group(1)), each))
+    if checkpoints:
+        shutil.copy(os.path.join(wd, max(checkpoints)[1]),
+                    os.path.join(wd, 'resume.tre'))
+    for each in os.listdir(wd):
+        if each.startswith('RAxML_') and output_file in each:
+            os.remove(os.path.join(wd, each))
+    return bool(checkpoints)
+
+
+# BACKENDS
+class Backend(object):
+    """Tree inference backend class : search() takes the same arguments \
+as RAxML"""
+    __metaclass__ = abc.ABCMeta
+    name = None
+    dep = None
+    threaded = True  # uses threads
+    concurrent = True  # can run several searches at once
+    checkpoints = False  # resumes from wd if checkpoint
+    timed = True  # is killed after timeout
+    constrained = True  # uses the constraint
+    constrained_starts = False  # takes a starting tree with the constraint
+    batches = False  # runs several searches together in searches()
+
+    @property
+    def available(self):
+        return True
+
+    def key(self, alignment):
+        """Return key of the runtimes of searches of alignment"""
+        return self.name
+
+    def _root(self, phylogeny, outgroup):
+        """Return phylogeny rooted with outgroup, if given"""
+        if phylogeny and outgroup:
+            phylogeny.root_with_outgroup(outgroup)
+        return phylogeny
+
+    @abc.abstractmethod
+    def search(self, alignment, wd, logger, threads, outgroup=None,
+               partitions=None, constraint=None, start=None, timeout=None,
+               checkpoint=False, pipes=None):
+        """Return phylogeny of alignment, or None. Partitions, constraint \
+and start are RAxML args for partitions.txt, constraint.tre and start.tre \
+in wd."""
+
+    def searches(self, alignment, wd, logger, threads, ntrees, outgroup=None,
+                 partitions=None, constraint=None, timeout=None, pipes=None):
+        """Return list of phylogenies of ntrees searches, one at a time \
+unless the backend can run them together"""
+        phylogenies = []
+        for _ in range(ntrees):
+            phylogeny = self.search(alignment, wd, logger, threads,
+                                    outgroup=outgroup, partitions=partitions,
+                                    constraint=constraint,
+                                    timeout=timeout / ntrees if timeout
+                                    else None, pipes=pipes)
+            if phylogeny:
+                phylogenies.append(phylogeny)
+        return phylogenies
+
+
+class RAxMLBackend(Backend):
+    """RAxML backend class"""
+    name = 'raxml'
+    dep = 'raxml'
+    checkpoints = True
+    batches = True
+
+    @property
+    def available(self):
+        return bool(raxml)
+
+    def key(self, alignment):
+        return '{0} {1}'.format(self.name, raxmlModel(alignment).split()[-1])
+
+    def search(self, alignment, wd, logger, threads, outgroup=None,
+               partitions=None, constraint=None, start=None, timeout=None,
+               checkpoint=False, pipes=None):
+        return RAxML(alignment, wd=wd, logger=logger, threads=threads,
+                     outgroup=outgroup, partitions=partitions,
+                     constraint=constraint, start=start, timeout=timeout,
+                     checkpoint=checkpoint, pipes=pipes)
+
+    def searches(self, alignment, wd, logger, threads, ntrees, outgroup=None,
+                 partitions=None, constraint=None, timeout=None, pipes=None):
+        return RAxML(alignment, wd=wd, logger=logger, threads=threads,
+                     outgroup=outgroup, partitions=partitions,
+                     constraint=constraint, timeout=timeout, ntrees=ntrees,
+                     pipes=pipes)
+
+
+class RAxMLNGBackend(Backend):
+    """RAxML-NG backend class"""
+    name = 'raxml-ng'
+    dep = 'raxmlng'
+    constrained_starts = True
+    batches = True
+
+    @property
+    def available(self):
+        return bool(raxmlng)
+
+    def search(self, alignment, wd, logger, threads, outgroup=None,
+               partitions=None, constraint=None, start=None, timeout=None,
+               checkpoint=False, pipes=None):
+        phylogenies = self._run(alignment, wd, logger, threads, outgroup,
+                                partitions, constraint, start, timeout,
+                                pipes=pipes)
+        return phylogenies[0] if phylogenies else None
+
+    def searches(self, alignment, wd, logger, threads, ntrees, outgroup=None,
+                 partitions=None, constraint=None, timeout=None, pipes=None):
+        return self._run(alignment, wd, logger, threads, outgroup,
+                         partitions, constraint, None, timeout, ntrees, pipes)
+
+    def _run(self, alignment, wd, logger, threads, outgroup, partitions,
+             constraint, start, timeout, ntrees=1, pipes=None):
+        """Return best phylogeny, or phylogenies of ntrees searches from \
+random starts, as a list"""
+        with ScratchSpace(wd) as scratch:
+            with open(os.path.join(scratch, 'phylogeny_in.phylip'), 'w') \
                     as file:
-                tree = Phylo.read(file, "newick")
-        except IOError:
+                asArray(alignment).write(file, 'phylip-relaxed')
+            # RAxML-NG has no master thread
+            cmd = [raxmlng, '--search', '--msa', 'phylogeny_in.phylip',
+                   '--prefix', 'phylogeny_out', '--seed',
+                   str(random.randint(0, 10000000)), '--threads',
+                   str(max(1, threads - 1)), '--model', 'GTR+G']
+            if partitions:
+                with open(os.path.join(wd, 'partitions.txt'), 'r') as file:
+                    text = ngPartitions(file.read())
+                with open(os.path.join(scratch, 'partitions.txt'), 'w') \
+                        as file:
+                    file.write(text)
+                cmd[-1] = 'partitions.txt'
+            if constraint:
+                shutil.copy(os.path.join(wd, 'constraint.tre'), scratch)
+                cmd += ['--tree-constraint', 'constraint.tre']
+            if start:
+                shutil.copy(os.path.join(wd, 'start.tre'), scratch)
+                cmd += ['--tree', 'start.tre']
+            elif ntrees > 1:
+                cmd += ['--tree', 'rand{{{0}}}'.format(ntrees)]
+            if outgroup:
+                cmd += ['--outgroup', outgroup]
+            logger.debug(' '.join(cmd))
+            pipe = TerminationPipe(cmd, silent=True, cwd=scratch,
+                                   timeout=timeout if timeout else 999999999,
+                                   pipes=pipes)
+            pipe.run()
+            logger.debug('.... CPU time [{0}] max RSS [{1}]'.
+                         format(pipe.cputime, pipe.maxrss))
+            if pipe.failure:
+                logger.debug('.... RAxML-NG timeout ....')
+                return []
+            outfile = 'phylogeny_out.raxml.' + ('mlTrees' if ntrees > 1 else
+                                                'bestTree')
+            try:
+                with open(os.path.join(scratch, outfile), 'r') as file:
+                    return list(Phylo.parse(file, 'newick'))
+            except IOError:
+                return []
+
+
+class FastTreeBackend(Backend):
+    """FastTree backend class : approximate ML, single threaded. FastTree \
+cannot use the partitions or the (tree) constraint."""
+    name = 'fasttree'
+    dep = 'fasttree'
+    threaded = False
+    constrained = False
+
+    @property
+    def available(self):
+        return bool(fasttree)
+
+    def search(self, alignment, wd, logger, threads, outgroup=None,
+               partitions=None, constraint=None, start=None, timeout=None,
+               checkpoint=False, pipes=None):
+        with ScratchSpace(wd) as scratch:
+            with open(os.path.join(scratch, 'phylogeny_in.fasta'), 'w') \
+                    as file:
+                asArray(alignment).write(file, 'fasta')
+            cmd = [fasttree, '-nt', '-gtr', '-quiet']
+            if start:
+                shutil.copy(os.path.join(wd, 'start.tre'), scratch)
+                cmd += ['-intree', 'start.tre']
+            cmd.append('phylogeny_in.fasta')
+            logger.debug(' '.join(cmd))
+            pipe = TerminationPipe(cmd, silent=True, cwd=scratch,
+                                   timeout=timeout if timeout else 999999999,
+                                   pipes=pipes)
+            pipe.run()
+            logger.debug('.... CPU time [{0}] max RSS [{1}]'.
+                         format(pipe.cputime, pipe.maxrss))
+        if pipe.failure:
+            logger.debug('.... FastTree timeout ....')
+            return None
+        if pipe.returncode or not pipe.stdout.strip():
+            return None
+        return self._root(Phylo.read(StringIO(pipe.stdout), 'newick'),
+                          outgroup)
+
+
+class NJBackend(Backend):
+    """Neighbour-joining backend class : built-in, for quick looks and \
+testing without external programs. Uses Jukes-Cantor distances and \
+ignores partitions, constraint and starting tree."""
+    name = 'nj'
+    threaded = False
+    concurrent = False
+    timed = False
+    constrained = False
+
+    def search(self, alignment, wd, logger, threads, outgroup=None,
+               partitions=None, constraint=None, start=None, timeout=None,
+               checkpoint=False, pipes=None):
+        alignment = asArray(alignment)
+        if len(alignment) < 3:
             return None
-        finally:
+        newick = neighbourJoining(alignment.ids, distanceMatrix(alignment))
+        return self._root(Phylo.read(StringIO(newick), 'newick'), outgroup)
+
+
+def getBackend(name):
+    """Return tree inference backend by name"""
+    backends = [RAxMLBackend, RAxMLNGBackend, FastTreeBackend, NJBackend]
+    for backend in backends:
+        if backend.name == name.lower():
+            return backend()
+    raise ValueError('Unknown backend [{0}]'.format(name))
+
+
+def ngPartitions(text):
+    """Return RAxML partition text as RAxML-NG partition text"""
+    text = re.sub('^DNA,', 'GTR+G,', text, flags=re.MULTILINE)
+    return text.replace('\\3', '/3')
+
+
+def distanceMatrix(alignment):
+    """Return Jukes-Cantor distances between sequences of alignment, \
+counting sites where both sequences have a nucleotide"""
+    codes = _nuc_codes[asArray(alignment).matrix]
+    nucs = (codes < 8).astype(np.float32)
+    shared = nucs.dot(nucs.T)
+    same = np.zeros(shared.shape, dtype=np.float32)
+    for base in range(4):
+        onehot = ((codes % 4 == base) & (codes < 8)).astype(np.float32)
+        same += onehot.dot(onehot.T)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pdist = 1 - same / shared
+        # p-distances of 0.75+ are saturated
+        distances = -0.75 * np.log(1 - 4.0 / 3 * np.minimum(pdist, 0.74))
+    # sequences without shared sites are as distant as the most distant
+    undefined = np.isnan(distances)
+    if undefined.any():
+        distances[undefined] = np.nanmax(distances) if not \
+            undefined.all() else 1.0
+    np.fill_diagonal(distances, 0)
+    return distances.astype(float)
+
+
+def constraintGroups(ids, constraint):
+    """Return the innermost clade of constraint (a Newick string) holding \
+each of ids, the parent of each clade and the number of tips and clades \
+directly in each clade. Clade 0 is the root, it holds ids not in \
+constraint."""
+    tree = Phylo.read(StringIO(constraint), 'newick')
+    index = dict([(e, i) for i, e in enumerate(ids)])
+    groups = [0] * len(ids)
+    parents = [None]
+    sizes = [0]
+    stack = [(tree.root, 0)]
+    while stack:
+        clade, group = stack.pop()
+        for child in clade.clades:
+            if child.is_terminal():
+                if child.name in index:
+                    groups[index[child.name]] = group
+                    sizes[group] += 1
+            else:
+                parents.append(group)
+                sizes.append(0)
+                sizes[group] += 1
+                stack.append((child, len(parents) - 1))
+    sizes[0] += len([e for e in ids if e not in
+                     set([t.name for t in tree.get_terminals()])])
+    # clades holding fewer than two of ids are merged into their parents,
+    #  children come after their parents so go backwards
+    for group in range(len(parents) - 1, 0, -1):
+        if sizes[group] > 1:
+            continue
+        sizes[parents[group]] -= 1 - sizes[group]
+        sizes[group] = 0
+        groups = [parents[group] if e == group else e for e in groups]
+    return groups, parents, sizes
+
+
+def neighbourJoining(ids, distances, constraint=None):
+    """Return unrooted neighbour-joining tree of distances as Newick. If \
+constraint (a Newick string) is given, only nodes in the same constraint \
+clade are joined, so its clades are kept."""
+    nodes = list(ids)
+    distances = np.array(distances, dtype=float)
+    if constraint:
+        groups, parents, sizes = constraintGroups(ids, constraint)
+        groups = np.array(groups)
+    # joined nodes replace the first of the pair in the matrix, the second
+    #  is masked out by an infinite total (so an infinite Q), and the matrix
+    #  is only compacted once half of it is masked
+    active = np.ones(len(nodes), dtype=bool)
+    totals = distances.sum(1)
+    q = np.empty_like(distances)
+    n = len(nodes)
+    while n > 3:
+        if n <= len(nodes) // 2:
+            keep = np.flatnonzero(active)
+            nodes = [nodes[k] for k in keep]
+            distances = distances[np.ix_(keep, keep)]
+            totals = totals[keep]
+            active = active[keep]
             if constraint:
-                os.remove(os.path.join(wd, 'constraint.tre'))
-            if partitions:
-                os.remove(os.path.join(wd, "partitions.txt"))
-            os.remove(os.path.join(wd, input_file))
-            all_files = os.listdir(wd)
-            for each in all_files:
-                if re.search("(RAxML)", each):
-                    os.remove(os.path.join(wd, each))
-                if re.search("\.reduced$", each):
-                    os.remove(os.path.join(wd, each))
-        return tree
+                groups = groups[keep]
+            q = np.empty_like(distances)
+        np.multiply(distances, n - 2, out=q)
+        q -= totals[:, None]
+        q -= totals[None, :]
+        np.fill_diagonal(q, np.inf)
+        if constraint:
+            q[groups[:, None] != groups[None, :]] = np.inf
+        i, j = np.unravel_index(np.argmin(q), q.shape)
+        di = 0.5 * distances[i, j] + (totals[i] - totals[j]) / (2 * (n - 2))
+        dj = distances[i, j] - di
+        nodes[i] = '({0}:{1:.6f},{2}:{3:.6f})'.format(nodes[i], max(di, 0),
+                                                      nodes[j], max(dj, 0))
+        active[j] = False
+        if constraint:
+            group = groups[i]
+            sizes[group] -= 1
+            if sizes[group] == 1 and parents[group] is not None:
+                # clade is complete, it is now a node of its parent clade
+                groups[i] = parents[group]
+        # distances from new node to others
+        new = 0.5 * (distances[i] + distances[j] - distances[i, j])
+        new[~active] = 0
+        new[i] = 0
+        totals += new - distances[:, i] - distances[:, j]
+        totals[i] = new.sum()
+        totals[j] = -np.inf
+        distances[i] = new
+        distances[:, i] = new
+        distances[j] = 0
+        distances[:, j] = 0
+        n -= 1
+    keep = np.flatnonzero(active)
+    nodes = [nodes[k] for k in keep]
+    distances = distances[np.ix_(keep, keep)]
+    if len(nodes) == 3:
+        d01, d02, d12 = distances[0, 1], distances[0, 2], distances[1, 2]
+        lengths = [(d01 + d02 - d12) / 2, (d01 + d12 - d02) / 2,
+                   (d02 + d12 - d01) / 2]
     else:
-        raise RuntimeError()
+        lengths = [distances[0, 1] / 2] * 2
+    return '(' + ','.join(['{0}:{1:.6f}'.format(e, max(l, 0)) for e, l in
+                           zip(nodes, lengths)]) + ');'
+
+
+def iterNewick(handle):
+    """Yield each Newick string of a file handle, one at a time"""
+    text = ''
+    for line in handle:
+        text += line
+        while ';' in text:
+            newick, text = text.split(';', 1)
+            if newick.strip():
+                yield newick.strip() + ';'
 
 
 def consensus(outdir, min_freq=0.5, is_rooted=True,
-              trees_splits_encoded=False):
-    """Generate a rooted consensus tree"""
-    # first ensure that all trees in the distribution have same number
-    # of taxa, otherwise, make it so by dropping taxa not present in
-    # all trees
-    all_tip_names = []
-    # read in from distribution.tre
-    phylogenies = []
-    phyloparse = Phylo.parse(os.path.join(outdir, 'distribution.tre'), 'newick')
-    for p in phyloparse:
-        phylogenies.append(p)
-    for phylogeny in phylogenies:
-        terminals = phylogeny.get_terminals()
-        all_tip_names.append([e.name for e in terminals])
-    counted = Counter(sum(all_tip_names, []))
-    to_drop = [e for e in counted.keys() if counted[e] < len(phylogenies)]
-    if (len(counted.keys()) - len(to_drop)) < 3:
+              trees_splits_encoded=False, counter=None):
+    """Generate a rooted consensus tree from distribution.tre, or from the \
+split counts of counter if given"""
+    # taxa not present in all trees are dropped by the counter
+    infile = os.path.join(outdir, 'distribution.tre')
+    if counter is None:
+        counter = SplitCounter()
+        counter.read(infile)
+    if len(counter.commonTaxa()) < 3:
         return False
-    for tip_names, phylogeny in zip(all_tip_names, phylogenies):
-        dropping = [e for e in tip_names if e in to_drop]
-        for tip_name in dropping:
-            phylogeny.prune(tip_name)
-    with open('.for_consensus.tre', "w") as file:
-        Phylo.write(phylogenies, file, 'newick')
-    # create dendropy list
-    trees = dp.TreeList()
-    trees.read_from_path('.for_consensus.tre', "newick", rooting='force-rooted')
-    os.remove('.for_consensus.tre')
-    # https://groups.google.com/forum/#!topic/dendropy-users/iJ32ibnS5Bc
-    sd = dp.SplitDistribution(taxon_namespace=trees.taxon_namespace)
-    #sd.is_rooted = is_rooted
-    tsum = dp.calculate.treesum.TreeSummarizer()
-    tsum.count_splits_on_trees(trees, split_distribution=sd)
-                               #trees_splits_encoded=trees_splits_encoded)
-    consensus = tsum.tree_from_splits(sd, min_freq=min_freq)
-    consensus.write_to_path(os.path.join(outdir, 'consensus.tre'), "newick")
+    newick = counter.consensus(min_freq=min_freq, is_rooted=is_rooted)
+    with open(os.path.join(outdir, 'consensus.tre'), 'w') as file:
+        file.write(newick + '\n')
     return True
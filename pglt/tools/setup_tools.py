@@ -405,7 +405,9 @@ def readInPars(pars_file):
                 'minspecies': None, 'minspecies_gene': None,
                 'minnseqs_gene': None, 'target_ngenes': None, 'maxpn': None,
                 'votesize': None, 'maxvotetrys': None, 'taxonomic_constraint':
-                None}
+                None, 'raxml_threads': None, 'backend': None, 'asdsf': None,
+                'minphylos': None, 'prescreen': None, 'njstarts': None,
+                'raxml_timeout': None, 'batch': None}
     # open file, read each row, extract value
     paradict = _read(pars_file, paradict)
     # if Nones remain, use default
@@ -11,6 +11,11 @@ import threading
 import os
 import Queue
 import pickle
+import shutil
+import tempfile
+import signal
+import errno
+import time
 from datetime import datetime
 from setup_tools import setUpLogging
 from setup_tools import tearDownLogging
@@ -266,8 +271,16 @@ class Runner(object):
 class TerminationPipe(object):
     """TerminationPipe class : exectute background programs. Adapted pG code \
 written by W.D. Pearse."""
-    def __init__(self, cmd, cwd=os.getcwd(), timeout=99999, silent=True):
+    grace = 5  # seconds between SIGTERM and SIGKILL
+
+    def __init__(self, cmd, cwd=os.getcwd(), timeout=99999, silent=True,
+                 stdin=None, pidfile=None, pipes=None):
         self.cmd = cmd
+        self.pidfile = pidfile  # holds pid while running
+        self.pipes = pipes  # PipeSet holding pipe while running
+        self.lock = threading.Lock()
+        self.thread = None
+        self.killed = False
         self.cwd = cwd
         self.timeout = timeout
         self.process = None
@@ -276,27 +289,233 @@ written by W.D. Pearse."""
         self.stderr = 'EMPTY'
         self.stdout = 'EMPTY'
         self.silent = silent
+        self.stdin = stdin
+        self.returncode = None
+        self.cputime = None  # seconds
+        self.maxrss = None  # as reported by the OS
+        self.walltime = None
+        self.shell = isinstance(cmd, basestring)  # lists run without one
+        self.posix = hasattr(os, 'setsid') and hasattr(os, 'wait4')
+
+    def _read(self, stream, i, output):
+        output[i] = stream.read()
+        stream.close()
+
+    def _write(self):
+        try:
+            self.process.stdin.write(self.stdin)
+        except IOError:
+            # program exited without reading all of its input
+            pass
+        self.process.stdin.close()
+
+    def _wait(self):
+        """Reap process, recording its return code and resource usage"""
+        while True:
+            try:
+                _, status, rusage = os.wait4(self.process.pid, 0)
+                break
+            except OSError as error:
+                if error.errno != errno.EINTR:
+                    raise
+        if os.WIFSIGNALED(status):
+            self.process.returncode = -os.WTERMSIG(status)
+        else:
+            self.process.returncode = os.WEXITSTATUS(status)
+        self.cputime = rusage.ru_utime + rusage.ru_stime
+        self.maxrss = rusage.ru_maxrss
+
+    def _communicate(self):
+        """Feed stdin and read stdout and stderr in threads to avoid \
+deadlocks, then wait on process"""
+        if not self.posix:
+            return self.process.communicate(self.stdin)
+        threads = []
+        output = [None, None]
+        if self.stdin is not None:
+            threads.append(threading.Thread(target=self._write))
+        if self.silent:
+            threads.append(threading.Thread(
+                target=self._read, args=(self.process.stdout, 0, output)))
+            threads.append(threading.Thread(
+                target=self._read, args=(self.process.stderr, 1, output)))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self._wait()
+        return tuple(output)
 
-    def run(self):
-        def silentTarget():
-            self.process = subprocess.Popen(self.cmd, stdout=subprocess.PIPE,
-                                            shell=True, stderr=subprocess.PIPE,
-                                            cwd=self.cwd)
-            self.output = self.process.communicate()
-
-        def loudTarget():
-            self.process = subprocess.Popen(self.cmd, shell=True, cwd=self.cwd)
-            self.output = self.process.communicate()
+    def _target(self):
+        if self.stdin is None:
+            stdin = None
+        else:
+            stdin = subprocess.PIPE
         if self.silent:
-            thread = threading.Thread(target=silentTarget)
+            stdout = stderr = subprocess.PIPE
+        else:
+            stdout = stderr = None
+        if self.posix:
+            preexec_fn = os.setsid
         else:
-            thread = threading.Thread(target=loudTarget)
+            preexec_fn = None
+        with self.lock:
+            if self.killed:
+                self.output = ('', 'killed before starting')
+                return
+            try:
+                self.process = subprocess.Popen(
+                    self.cmd, shell=self.shell, stdin=stdin, stdout=stdout,
+                    stderr=stderr, cwd=self.cwd, preexec_fn=preexec_fn)
+            except OSError as error:
+                # without a shell, a missing program raises here
+                self.output = ('', str(error))
+                return
+        if self.pidfile:
+            with open(self.pidfile, 'w') as file:
+                file.write('{0}\n'.format(self.process.pid))
+        self.output = self._communicate()
+        if self.pidfile:
+            try:
+                os.remove(self.pidfile)
+            except OSError:
+                pass
+        if self.silent:
+            self.stdout, self.stderr = self.output
+
+    def _kill(self, thread):
+        """Terminate process and its children, kill if still running \
+after grace seconds"""
+        if self.process is None:
+            return
+        if not self.posix:
+            self.process.terminate()
+            return
+        for sig in (signal.SIGTERM, signal.SIGKILL):
+            try:
+                os.killpg(self.process.pid, sig)
+            except OSError:
+                # process group has already gone
+                return
+            thread.join(self.grace)
+            if not thread.is_alive():
+                return
+
+    def kill(self):
+        """Kill program from another thread, or stop it being started"""
+        with self.lock:
+            self.killed = True
+        if self.thread:
+            self._kill(self.thread)
+
+    def run(self):
+        """Run program until it ends or timeout, then kill it and its \
+children (also if interrupted)"""
+        start = time.time()
+        if self.pipes is not None:
+            self.pipes.add(self)
+        self.thread = thread = threading.Thread(target=self._target)
         thread.start()
-        thread.join(self.timeout)
+        try:
+            thread.join(self.timeout)
+        except BaseException:
+            # the program is not in our process group, so is not sent the
+            #  signal that interrupted us: kill it rather than orphan it
+            self._kill(thread)
+            raise
+        finally:
+            if self.pipes is not None:
+                self.pipes.discard(self)
         if thread.is_alive():
-            self.process.terminate()
+            self._kill(thread)
             thread.join()
             self.failure = True
+        if self.killed:
+            self.failure = True
+        self.walltime = time.time() - start
+        if self.process:
+            self.returncode = self.process.returncode
+        else:
+            self.returncode = 127  # as for a shell's command not found
+
+
+class PipeSet(object):
+    """PipeSet class : the running TerminationPipes of one caller, so they \
+can be killed together"""
+
+    def __init__(self):
+        self.pipes = set()
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def add(self, pipe):
+        """Add pipe, or kill it if the set has been killed"""
+        with self.lock:
+            if not self.closed:
+                self.pipes.add(pipe)
+                return
+        pipe.kill()
+
+    def discard(self, pipe):
+        with self.lock:
+            self.pipes.discard(pipe)
+
+    def kill(self):
+        """Kill pipes, and any added from now on"""
+        with self.lock:
+            self.closed = True
+            pipes = list(self.pipes)
+        for pipe in pipes:
+            pipe.kill()
+
+
+class ScratchSpace(object):
+    """ScratchSpace class : a unique, automatically cleaned directory for a \
+single call to an external program. Used as a context manager:
+
+    with ScratchSpace(wd) as scratch:
+        ...
+
+If use_tmpfs, the directory is made on tmpfs (e.g. /dev/shm) so long as \
+there is at least budget bytes free there, otherwise it is made in wd."""
+    tmpfs = '/dev/shm'
+    use_tmpfs = True
+    budget = 100 * 1024 ** 2  # bytes
+
+    def __init__(self, wd, prefix='pglt_', use_tmpfs=None, budget=None):
+        self.wd = wd
+        self.prefix = prefix
+        if use_tmpfs is not None:
+            self.use_tmpfs = use_tmpfs
+        if budget is not None:
+            self.budget = budget
+        self.path = None
+
+    def _free(self, directory):
+        """Return bytes free in directory, None if unknown"""
+        try:
+            stats = os.statvfs(directory)
+        except (AttributeError, OSError):
+            return None
+        return stats.f_bavail * stats.f_frsize
+
+    def _root(self):
+        """Return directory in which to make scratch space"""
+        if self.use_tmpfs and os.path.isdir(self.tmpfs) and\
+                os.access(self.tmpfs, os.W_OK):
+            free = self._free(self.tmpfs)
+            if free is not None and free > self.budget:
+                return self.tmpfs
+        return self.wd
+
+    def __enter__(self):
+        self.path = tempfile.mkdtemp(prefix=self.prefix, dir=self._root())
+        return self.path
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        shutil.rmtree(self.path, ignore_errors=True)
+        self.path = None
+        return False
 
 
 # FUNCTIONS
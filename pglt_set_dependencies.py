@@ -16,6 +16,8 @@ from pglt import _MAFFT as mafft
 from pglt import _MAFFTQ as mafftq
 from pglt import _MAFFTX as mafftx
 from pglt import _BLASTN as blastn
+from pglt import _RAXMLNG as raxmlng
+from pglt import _FASTTREE as fasttree
 from pglt import _ROOT as root
 
 # GLOBALS
@@ -37,6 +39,10 @@ search current working directory", type=str)
 current working directory", type=str)
     parser.add_argument("-blastn", help="path to `blastn`, by default will \
 search current working directory", type=str)
+    parser.add_argument("-raxmlng", help="path to `raxml-ng` (optional), by \
+default will search current working directory", type=str)
+    parser.add_argument("-fasttree", help="path to `FastTree` (optional), by \
+default will search current working directory", type=str)
     parser.add_argument('--overwrite', help='overwrite dependencies already \
 added to pG-lt', action='store_true')
     parser.add_argument('--local', help='add deps to local pglt for testing \
@@ -126,6 +132,22 @@ if __name__ == '__main__':
             changes = True
         else:
             print 'No Stand-alone BLAST detected -- requires BLAST suite v2+'
+    # RAXML-NG
+    if args.raxmlng and (not raxmlng or args.overwrite):
+        version = getVersion([args.raxmlng, '--version'])
+        if version and version >= 0.9:
+            depsdict['raxmlng'] = args.raxmlng
+            changes = True
+        else:
+            print 'No RAxML-NG detected'
+    # FASTTREE
+    if args.fasttree and (not fasttree or args.overwrite):
+        version = getVersion([args.fasttree, '-expert'])
+        if version and version > 2.0:
+            depsdict['fasttree'] = args.fasttree
+            changes = True
+        else:
+            print 'No FastTree detected -- requires FastTree v2+'
     if changes:
         with open(os.path.join(root, 'dependencies.p'), "wb") as file:
             pickle.dump(depsdict, file)
@@ -138,11 +160,12 @@ if __name__ == '__main__':
     print(' ' * 23 + 'Set dependencies' + ' ' * 23)
     print('-'*70)
     deps = [('mafft', '3'), ('mafftq', '-'), ('mafftx', '-'),
-            ('raxml', '4'), ('blastn', '2-3')]
+            ('raxml', '4'), ('blastn', '2-3'), ('raxmlng', '-'),
+            ('fasttree', '-')]
     rows = []
     headers = ['Dependency', 'Status', 'Stages required', 'Path']
     for d, e in deps:
-        if depsdict[d]:
+        if depsdict.get(d):
             rows.append([d, 'Present', e, depsdict[d]])
         else:
             rows.append([d, 'Absent', e, '-'])
@@ -7,17 +7,27 @@ Test alignment stage.
 
 import unittest
 import pickle
+import logging
 import os
 import shutil
 from pglt.stages import alignment_stage
 from Bio import AlignIO
 from pglt.tools.alignment_tools import mafft
+from pglt.tools.system_tools import MafftError
 
 # DIRS
 working_dir = os.path.dirname(__file__)
 
 
 # DUMMIES
+class Dummy_Logger(object):
+    def info(self, msg):
+        pass
+
+    def debug(self, msg):
+        pass
+
+
 class Dummy_SeqStore(object):
     def __init__(self, gene_dir, seq_files, maxfails, maxgaps, minoverlap,
                  logger, wd):
@@ -39,6 +49,11 @@ class Dummy_Aligner(object):
     def run(self):
         return alignment
 
+
+class Dummy_FailingAligner(object):
+    def run(self):
+        raise MafftError('MAFFT failed')
+
 # TEST DATA
 # reference alignment
 with open(os.path.join(working_dir, 'data',
@@ -108,5 +123,63 @@ class AlignmentStageTestSuite(unittest.TestCase):
         res = alignment_stage.run()
         self.assertIsNone(res)
 
+
+class AlignmentWorkersTestSuite(unittest.TestCase):
+    # replicate and gene workers only use the dummies, MAFFT is not needed
+
+    def setUp(self):
+        self.True_SeqStore = alignment_stage.atools.SeqStore
+        self.True_Aligner = alignment_stage.atools.Aligner
+        alignment_stage.atools.SeqStore = Dummy_SeqStore
+        alignment_stage.atools.Aligner = Dummy_Aligner
+        os.mkdir('tempfiles')
+
+    def tearDown(self):
+        for folder in ['3_alignment', 'tempfiles']:
+            if os.path.isdir(folder):
+                shutil.rmtree(folder)
+        alignment_stage.atools.SeqStore = self.True_SeqStore
+        alignment_stage.atools.Aligner = self.True_Aligner
+
+    def test_run_aligner_replicates(self):
+        # run 3 replicates at once, each alignment should be written and
+        #  counted once
+        gene_dir = os.path.join('tempfiles', 'rbcl')
+        os.mkdir(gene_dir)
+        aligner = Dummy_Aligner(*[None] * 11)
+        test_namesdict = dict([(e, {'alignments': 0}) for e in names])
+        res = alignment_stage.runAligner(aligner, 5, test_namesdict, gene_dir,
+                                         logger=Dummy_Logger(), nreplicates=3)
+        self.assertEqual(res, 6)
+        self.assertEqual(len(os.listdir(gene_dir)), 6)
+        self.assertEqual(test_namesdict[names[0]]['alignments'], 6)
+
+    def test_run_replicates_errors(self):
+        # errors in a worker are raised in the parent, as when run serially
+        gene_dir = os.path.join('tempfiles', 'rbcl')
+        os.mkdir(gene_dir)
+        aligner = Dummy_FailingAligner()
+        test_namesdict = dict([(e, {'alignments': 0}) for e in names])
+        self.assertRaises(MafftError, alignment_stage.runReplicates, aligner,
+                          range(1, 5), test_namesdict, gene_dir,
+                          Dummy_Logger(), 2)
+
+    def test_run_genes(self):
+        # align both genes at once, counts should be merged into namesdict
+        os.mkdir('3_alignment')
+        genestore = [('COI', Dummy_SeqStore(*[None] * 7)),
+                     ('rbcl', Dummy_SeqStore(*[None] * 7))]
+        genekeys = {'COI': 'COI', 'rbcl': 'rbcl'}
+        test_namesdict = dict([(e, {'alignments': 0}) for e in names])
+        logger = logging.getLogger('test_run_genes')
+        res = alignment_stage.runGenes(genestore, genedict, genekeys, 1,
+                                       test_namesdict, '3_alignment', 2, 2,
+                                       logger, 'tempfiles')
+        self.assertEqual(res, 4)
+        self.assertEqual(test_namesdict[names[0]]['alignments'], 4)
+        # gene logs should have been merged and removed
+        self.assertFalse([e for e in os.listdir('tempfiles') if
+                          e.endswith('_log.txt')])
+
 if __name__ == '__main__':
     unittest.main()
@@ -32,7 +32,14 @@ def dummyCountNPhylos(nphylos, f):
     return nphylos
 
 class DummyAlignmentStore(object):
-    def __init__(self, clusters, genedict, allrankids, indir, logger):
+    def __init__(self, clusters, genedict, allrankids, indir, logger,
+                 lazy=False):
+        pass
+
+    def restore(self, outdir):
+        pass
+
+    def report(self, outdir):
         pass
 
 
@@ -43,9 +50,15 @@ class DummyGenerator(object):
                  wd):
         pass
 
-    def run(self):
+    def resume(self):
+        return 0
+
+    def generate(self):
         self.phylogenies.append(genPhylogeny())
-        return True
+        return self.phylogenies[-1]
+
+    def run(self):
+        return self.generate() is not None
 
 
 # TEST DATA
@@ -117,5 +130,44 @@ class PhylogenyStageTestSuite(unittest.TestCase):
         # assert
         self.assertIsNone(res)
 
+
+class PhylogenyStageNJTestSuite(unittest.TestCase):
+
+    def setUp(self):
+        # run stage with built-in backend, no stubs
+        nj_paradict = paradict.copy()
+        # nj runs one search per draw, whatever the batch
+        nj_paradict.update({'nphylos': '2', 'rttstat': '10',
+                            'backend': 'nj', 'batch': '2'})
+        nj_genedict = {'COI': {'partition': 'False'},
+                       'rbcl': {'partition': 'False'}}
+        os.mkdir('tempfiles')
+        with open(os.path.join('tempfiles', "paradict.p"), "wb") as file:
+            pickle.dump(nj_paradict, file)
+        with open(os.path.join('tempfiles', "genedict.p"), "wb") as file:
+            pickle.dump(nj_genedict, file)
+        with open(os.path.join('tempfiles', "allrankids.p"), "wb") as file:
+            pickle.dump(allrankids, file)
+        os.mkdir('3_alignment')
+        os.mkdir('4_phylogeny')
+        for gene in ['COI', 'rbcl']:
+            os.mkdir(os.path.join('3_alignment', gene))
+            with open(os.path.join('3_alignment', gene,
+                                   'test_alignment.faa'), 'w') as file:
+                AlignIO.write(alignment, file, "fasta")
+
+    def tearDown(self):
+        for folder in ['3_alignment', '4_phylogeny', 'tempfiles']:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    def test_phylogeny_stage_nj(self):
+        res = pstage.run()
+        self.assertIsNone(res)
+        trees = list(Phylo.parse(os.path.join('4_phylogeny',
+                                              'distribution.tre'), 'newick'))
+        self.assertEqual(len(trees), 2)
+        self.assertTrue(os.path.isfile(os.path.join('4_phylogeny',
+                                                    'consensus.tre')))
+
 if __name__ == '__main__':
     unittest.main()
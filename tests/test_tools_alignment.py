@@ -12,6 +12,7 @@ import copy
 import pickle
 import random
 import pglt.tools.alignment_tools as atools
+from pglt.tools.array_tools import FastaRecord
 from pglt import _MAFFT as mafft
 from pglt import _MAFFTQ as mafftq
 from pglt import _MAFFTX as mafftx
@@ -193,6 +194,16 @@ class AlignmentTestSuite(unittest.TestCase):
                                     minlen=1, logger=self.logger)
         self.assertFalse(res)
 
+    def test_alignment_stats(self):
+        # three sequences: gaps are counted as runs, overlap is nucleotides
+        #  less the proportion of other sequences with gaps there
+        alignment = atools.MultipleSeqAlignment(
+            [SeqRecord(Seq('AAAA'), id='a'), SeqRecord(Seq('-AA-'), id='b'),
+             SeqRecord(Seq('--A-'), id='c')])
+        ngaps, overlaps = atools.alignmentStats(alignment)
+        self.assertEqual(list(ngaps), [0, 2, 2])
+        self.assertEqual(list(overlaps), [1.5, 1.5, 1.0])
+
     def test_checkalignment_arg_minlen(self):
         # check minlen argument
         res = atools.checkAlignment(test_alignment, maxgaps=0.5, minoverlap=1,
@@ -242,6 +253,19 @@ class AlignmentTestSuite(unittest.TestCase):
         # the species should no longer be in the pool
         self.assertFalse(res[0].id in store.sppool)
 
+    def test_seqstore_lazy(self):
+        store = copy.deepcopy(self.store)
+        # sequences are only parsed once taken from the store
+        entries = [e for sp in store.keys() for e in store[sp][0]]
+        self.assertTrue(all([isinstance(e[0], FastaRecord) for e in
+                             entries]))
+        store.sppool = store.keys()
+        store.sequences_in_alignment = []
+        res = store._add()
+        self.assertTrue(isinstance(res, SeqRecord))
+        self.assertEqual(res.id, store.next_sp)
+        self.assertTrue(store.sequences_in_alignment[0][0] is res)
+
     def test_seqstore_start(self):
         store = copy.deepcopy(self.store)
         seqs = store.start(3)
@@ -0,0 +1,116 @@
+#! /bin/usr/env python
+# D.J. Bennett
+# 19/10/2026
+"""
+Tests for array tools.
+"""
+
+import unittest
+import os
+import pickle
+from StringIO import StringIO
+from Bio import SeqIO
+from Bio import AlignIO
+import pglt.tools.array_tools as artools
+
+# DIRS
+working_dir = os.path.dirname(__file__)
+
+# TEST DATA
+with open(os.path.join(working_dir, "data", "test_alignment.p"), "r") as file:
+    test_alignment = pickle.load(file)
+
+
+class ArrayTestSuite(unittest.TestCase):
+
+    def setUp(self):
+        self.alignment = artools.ArrayAlignment.fromSequences(
+            ['A', 'B', 'C'], ['atgcc-', 'atg---', 'a-gcca'])
+
+    def test_array_alignment(self):
+        self.assertEqual(len(self.alignment), 3)
+        self.assertEqual(self.alignment.get_alignment_length(), 6)
+        self.assertEqual([e.id for e in self.alignment], ['A', 'B', 'C'])
+        self.assertEqual(self.alignment[1].seq, 'atg---')
+        self.assertEqual(self.alignment[:, 1], 'tt-')
+        self.assertEqual(self.alignment.sequence('C').tostring(), 'a-gcca')
+
+    def test_array_alignment_views(self):
+        # slices and frames share memory with parent
+        sliced = self.alignment[1:, 2:]
+        self.assertEqual([e.seq for e in sliced], ['g---', 'gcca'])
+        self.assertTrue(sliced.matrix.base is not None)
+        frame = self.alignment.frame(1)
+        self.assertEqual(frame.get_alignment_length(), 3)
+        self.assertEqual(frame[0].seq, 'tgc')
+
+    def test_bio_conversion(self):
+        alignment = artools.asArray(test_alignment)
+        self.assertEqual(len(alignment), len(test_alignment))
+        self.assertEqual(alignment.get_alignment_length(),
+                         test_alignment.get_alignment_length())
+        bio = alignment.toBio()
+        self.assertEqual([str(e.seq) for e in bio],
+                         [str(e.seq) for e in test_alignment])
+        self.assertTrue(artools.asArray(alignment) is alignment)
+
+    def test_fasta(self):
+        handle = StringIO()
+        AlignIO.write(test_alignment, handle, 'fasta')
+        handle.seek(0)
+        alignment = artools.readFasta(handle)
+        self.assertEqual([e.id for e in alignment],
+                         [e.id for e in test_alignment])
+        self.assertEqual([e.seq for e in alignment],
+                         [str(e.seq) for e in test_alignment])
+        # round trip
+        handle = StringIO()
+        alignment.write(handle, 'fasta')
+        handle.seek(0)
+        res = AlignIO.read(handle, 'fasta')
+        self.assertEqual([str(e.seq) for e in res],
+                         [e.seq for e in alignment])
+
+    def test_phylip(self):
+        handle = StringIO()
+        self.alignment.write(handle, 'phylip-relaxed')
+        handle.seek(0)
+        res = artools.readPhylip(handle)
+        self.assertEqual(res.ids, self.alignment.ids)
+        self.assertEqual((res.matrix == self.alignment.matrix).all(), True)
+
+    def test_fasta_file(self):
+        path = os.path.join(working_dir, 'data', 'test_sequences.faa')
+        with open(path, 'rU') as file:
+            records = list(SeqIO.parse(file, 'fasta'))
+        with artools.FastaFile(path) as fasta:
+            self.assertEqual(len(fasta), len(records))
+            self.assertEqual(fasta.lengths(), [len(e) for e in records])
+            res = [e.toSeqRecord() for e in fasta]
+        self.assertEqual([e.id for e in res], [e.id for e in records])
+        self.assertEqual([e.description for e in res],
+                         [e.description for e in records])
+        self.assertEqual([str(e.seq) for e in res],
+                         [str(e.seq) for e in records])
+
+    def test_fasta_file_closed(self):
+        # no file descriptor is held per indexed file
+        if not os.path.isdir('/proc/self/fd'):
+            return
+        path = os.path.join(working_dir, 'data', 'test_sequences.faa')
+        nfds = len(os.listdir('/proc/self/fd'))
+        fastas = [artools.FastaFile(path) for _ in range(10)]
+        self.assertEqual(len(os.listdir('/proc/self/fd')), nfds)
+        self.assertEqual(fastas[-1][0].seq, fastas[0].sequence(0))
+
+    def test_read_fasta_file(self):
+        path = os.path.join(working_dir, 'data', 'test_alignment_ref.faa')
+        with open(path, 'rU') as file:
+            expected = AlignIO.read(file, 'fasta')
+        alignment = artools.readFastaFile(path)
+        self.assertEqual(alignment.ids, [e.id for e in expected])
+        self.assertEqual(alignment.get_alignment_length(),
+                         expected.get_alignment_length())
+
+if __name__ == '__main__':
+    unittest.main()
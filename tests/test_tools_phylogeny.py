@@ -10,10 +10,20 @@ import pickle
 import os
 import shutil
 import re
+import random
+import subprocess
+import time
+import numpy as np
 from copy import deepcopy
+from StringIO import StringIO
 from Bio import Phylo
 from Bio import AlignIO
+from Bio import SeqIO
 import pglt.tools.phylogeny_tools as ptools
+try:
+    import dendropy as dp
+except ImportError:
+    dp = None
 
 # DIRS
 working_dir = os.path.dirname(__file__)
@@ -58,7 +68,10 @@ class dummy_Logger(object):
 
 
 def dummy_RAxML(alignment, wd, logger, threads, outgroup=None, partitions=None,
-                constraint=None, timeout=999999999):
+                constraint=None, timeout=999999999, start=None, ntrees=1,
+                checkpoint=False, pipes=None):
+    if ntrees > 1:
+        return [test_phylo] * ntrees
     return test_phylo
 
 
@@ -121,6 +134,7 @@ class PhylogenyTestSuite(unittest.TestCase):
         ptools.RAxML = self.true_RAxML
         # remove all files potentially generated by ptools
         ptool_files = ['constraint.tre', 'distribution.tre', 'consensus.tre',
+                       'calibration.p', 'runtimes.p',
                        '.phylogeny_in.phylip.reduced',
                        'RAxML_info..phylogeny_out', '.phylogeny_in.phylip',
                        '.partitions.txt.reduced', 'partitions.txt',
@@ -133,7 +147,7 @@ class PhylogenyTestSuite(unittest.TestCase):
                 os.remove(ptool_file)
             except OSError:
                 pass
-        phylogeny_folders = ['3_alignment', '4_phylogeny']
+        phylogeny_folders = ['3_alignment', '4_phylogeny', 'checkpoints']
         while phylogeny_folders:
             try:
                 phylogeny_folder = phylogeny_folders.pop()
@@ -164,6 +178,62 @@ class PhylogenyTestSuite(unittest.TestCase):
         self.assertTrue(len(test_alignments[1]) in alens)
         self.assertEqual(stops, stops)
 
+    def test_alignment_store_lazy(self):
+        store = ptools.AlignmentStore(clusters=['gene1_cluster0',
+                                                'gene2_cluster0'],
+                                      genedict=genedict, allrankids=[],
+                                      indir='3_alignment', logger=self.logger,
+                                      lazy=True, cache_size=3)
+        self.assertEqual(store.cache, {})
+        for i in range(5):
+            alignments, stops = store.pull()
+            alens = [len(e) for e in alignments]
+            self.assertTrue(len(test_alignments[0]) in alens)
+            self.assertTrue(len(test_alignments[1]) in alens)
+            # next draw is read while this one is searched
+            self.assertTrue(store.draw is not None)
+            store.count(alignments, True)
+        store.prefetcher.join()
+        # cache is bounded
+        self.assertTrue(len(store.cache) <= 3)
+
+    def test_alignment_store_redraw(self):
+        store = ptools.AlignmentStore(clusters=['gene1_cluster0',
+                                                'gene2_cluster0'],
+                                      genedict=genedict, allrankids=[],
+                                      indir='3_alignment', logger=self.logger,
+                                      lazy=True)
+        alignments, _ = store.pull()
+        draw = store.draw
+        # a failure that blacklists a prefetched alignment draws again
+        gene = store.keys()[0]
+        genedata = store[gene]
+        genedata['failures'][draw[0]] = store.max_failures
+        genedata['partners'][draw[0]] = set(
+            [(('other', k),) for k in range(store.max_failures)])
+        store.count(alignments, True)
+        self.assertTrue(store.draw is draw)
+        store.count(alignments, False)
+        self.assertNotEqual(store.draw[0], draw[0])
+        store.prefetcher.join()
+
+    def test_alignment_store_frames(self):
+        stops = (re.compile('(taa|tag)', flags=re.IGNORECASE),
+                 re.compile('(tta|cta)', flags=re.IGNORECASE))
+        self.alignment_store['gene2_cluster0']['stop'] = stops
+        alignments, frames = self.alignment_store.pull()
+        i = self.alignment_store.keys().index('gene2_cluster0')
+        self.assertEqual(frames[i], ptools.findFrame(test_alignments[1],
+                                                     stops))
+        self.assertIsNone(frames[1 - i])
+        # frame is cached on disk
+        self.assertTrue(os.path.isfile(os.path.join(
+            '3_alignment', 'gene2_cluster0', '.frames.p')))
+        store = ptools.AlignmentStore(clusters=['gene2_cluster0'],
+                                      genedict=genedict, allrankids=[],
+                                      indir='3_alignment', logger=self.logger)
+        self.assertEqual(len(store['gene2_cluster0']['frames']), 1)
+
     def test_generator_private_test(self):
         # the test phylo should pass the test
         self.assertTrue(self.generator._test(phylogeny=self.phylo))
@@ -172,6 +242,24 @@ class PhylogenyTestSuite(unittest.TestCase):
         bad_phylo.get_terminals()[0].branch_length = 100000
         self.assertIsNone(self.generator._test(phylogeny=bad_phylo))
 
+    def test_rtt_stat(self):
+        phylo = deepcopy(self.phylo)
+        expected = dict([(e.name, phylo.distance(e)) for e in
+                         phylo.get_terminals()])
+        self.assertEqual(sorted(expected.keys()),
+                         sorted([e[0] for e in ptools.rootToTip(phylo)]))
+        for name, distance in ptools.rootToTip(phylo):
+            self.assertAlmostEqual(distance, expected[name])
+        rttstat, distances = ptools.rttStat(phylo)
+        values = expected.values()
+        mean = sum(values) / len(values)
+        sd = (sum([(e - mean) ** 2 for e in values]) / len(values)) ** 0.5
+        self.assertAlmostEqual(rttstat, sd / mean)
+        # outgroup is pruned
+        rttstat, distances = ptools.rttStat(phylo,
+                                            outgroup=self.poutgroups[0])
+        self.assertEqual(len(distances), len(expected) - 1)
+
     def test_generator_private_concatenate(self):
         # give it the test_alignments and a bigger alignment should return
         full_length = test_alignments[0].get_alignment_length() + \
@@ -179,6 +267,40 @@ class PhylogenyTestSuite(unittest.TestCase):
         alignment = self.generator._concatenate(test_alignments)
         self.assertEqual(alignment.get_alignment_length(), full_length)
 
+    def test_generator_supermatrix_fasta(self):
+        # multigene supermatrix keeps its IDs when written as FASTA
+        alignment = self.generator._supermatrix(test_alignments,
+                                                [None, None])[0]
+        handle = StringIO()
+        alignment.write(handle, 'fasta')
+        handle.seek(0)
+        records = list(SeqIO.parse(handle, 'fasta'))
+        self.assertEqual([e.id for e in records], alignment.ids)
+        self.assertEqual(records[0].description,
+                         alignment.ids[0] + ' multigene sequence')
+
+    def test_generator_private_supermatrix(self):
+        # gene blocks match their alignments, missing taxa are gaps
+        alignments = [ptools.asArray(e) for e in test_alignments]
+        alignments[0] = alignments[0][1:]
+        alignment, text = self.generator._supermatrix(alignments, [None, 1])
+        alen = alignments[0].get_alignment_length()
+        for record in test_alignments[1]:
+            self.assertEqual(alignment.sequence(record.id)[alen:].tostring(),
+                             str(record.seq)[1:1378])
+        missing = test_alignments[0][0].id
+        self.assertEqual(alignment.sequence(missing)[:alen].tostring(),
+                         '-' * alen)
+        self.assertEqual(text, 'DNA, gene1 = 1-1761\n'
+                         'DNA, gene2codon1 = 1762-3138\\3\n'
+                         'DNA, gene2codon2 = 1763-3138\\3\n'
+                         'DNA, gene2codon3 = 1764-3138\\3\n')
+        # supermatrices of alignment files are cached
+        alignments, frames = self.alignment_store.pull()
+        res = self.generator._supermatrix(alignments, frames)
+        self.assertTrue(self.generator._supermatrix(alignments, frames)[0] is
+                        res[0])
+
     def test_generator_private_constraint(self):
         # 4 tips in taxon tree not present in alignment
         carg = self.generator._constraint(test_alignment)
@@ -188,6 +310,20 @@ class PhylogenyTestSuite(unittest.TestCase):
         self.assertEqual(len(constraint.get_terminals()), 11)
         self.assertEqual(carg, self.carg)
 
+    def test_constraint_tree(self):
+        tree = ptools.ConstraintTree(os.path.join(self.generator.outdir,
+                                                  'taxontree.tre'))
+        tips = [e.id for e in test_alignment]
+        newick, bifurcating, distances = tree.prune(tips)
+        constraint = Phylo.read(StringIO(newick), 'newick')
+        self.assertEqual(sorted([e.name for e in constraint.get_terminals()]),
+                         sorted(tips))
+        self.assertEqual(bifurcating, constraint.is_bifurcating())
+        for tip in tips:
+            self.assertAlmostEqual(distances[tip], constraint.distance(tip))
+        # pruned trees are cached by tip set
+        self.assertTrue(tree.prune(reversed(tips)) is tree.cached(tips))
+
     def test_generator_private_outgroup(self):
         # check with outgroup
         alignment = genAlignment(['outgroup', 'F', 'B', 'H'])
@@ -199,6 +335,10 @@ class PhylogenyTestSuite(unittest.TestCase):
         res = self.generator._outgroup(test_alignment)
         # should return one of the basal tips from the constraint
         self.assertTrue(res in self.poutgroups)
+        # using distances cached by _constraint
+        self.generator._constraint(test_alignment)
+        res = self.generator._outgroup(test_alignment)
+        self.assertTrue(res in [e.id for e in test_alignment])
 
     def test_generator_private_findorf(self):
         # find frames in test alignments[1] -- rcbl
@@ -217,6 +357,21 @@ class PhylogenyTestSuite(unittest.TestCase):
                                                  stop=stops)
         self.assertFalse(res)
 
+    def test_find_frame(self):
+        stops = (re.compile('(taa|tag)', flags=re.IGNORECASE),
+                 re.compile('(tta|cta)', flags=re.IGNORECASE))
+        self.assertEqual(ptools.findFrame(test_alignments[1], stops), 2)
+        self.assertIsNone(ptools.findFrame(test_alignments[0], stops))
+        # stop codons in frame 2 are found in upper case too
+        alignment = ptools.asArray(test_alignments[1])
+        upper = ptools.ArrayAlignment(alignment.ids, np.frombuffer(
+            alignment.matrix.tostring().upper(), dtype=np.uint8).
+            reshape(alignment.matrix.shape))
+        self.assertEqual(ptools.findFrame(upper, stops), 2)
+        # ... but not with case sensitive patterns
+        stops = (re.compile('(taa|tag)'), re.compile('(tta|cta)'))
+        self.assertIsNone(ptools.findFrame(upper, stops))
+
     def test_generator_private_partition(self):
         # create partition text for the two genes, make sure they're correct
         alignment, parg = self.generator._partition(test_alignments,
@@ -226,12 +381,22 @@ class PhylogenyTestSuite(unittest.TestCase):
             text = file.read()
         self.assertEqual(text, self.partition_text)
         self.assertEqual(parg, self.parg)
-        # TODO: repeat above for codon partitioned alignments
+        # codon partition second gene from its second position
+        alignments, parg = self.generator._partition(test_alignments,
+                                                     [None, 1])
+        with open('partitions.txt', 'r') as file:
+            text = file.read()
+        self.assertEqual(text, 'DNA, gene1 = 1-1761\n'
+                         'DNA, gene2codon1 = 1762-3138\\3\n'
+                         'DNA, gene2codon2 = 1763-3138\\3\n'
+                         'DNA, gene2codon3 = 1764-3138\\3\n')
+        self.assertEqual(alignments[1].get_alignment_length(), 1377)
 
     def test_generator_private_setup(self):
         # test concatenate, contstraint, outgroup and partition in one
-        alignment, carg, outgroup, parg = \
+        alignment, carg, outgroup, parg, size = \
             self.generator._setUp(test_alignments, [None, None])
+        self.assertEqual(size, None)
         self.assertEqual(alignment.get_alignment_length(),
                          test_alignment.get_alignment_length())
         self.assertEqual(carg, self.carg)
@@ -241,6 +406,458 @@ class PhylogenyTestSuite(unittest.TestCase):
     def test_generator_run(self):
         self.assertTrue(self.generator.run())
 
+    def test_generator_generate(self):
+        self.assertTrue(self.generator.generate())
+        # nothing is left in the working directory
+        self.assertFalse([e for e in os.listdir('.') if
+                          e.startswith('search_')])
+
+    def test_generator_private_start(self):
+        alignment = ptools.asArray(test_alignment)
+        self.assertEqual(self.generator._start(alignment, None), None)
+        self.generator.starts = 1
+        # not with a constraint, unless the backend takes both
+        self.assertEqual(self.generator._start(alignment, self.carg), None)
+        self.generator._constraint(alignment)
+        self.generator.backend = ptools.RAxMLNGBackend()
+        self.assertEqual(self.generator._start(alignment, self.carg),
+                         ' -t start.tre')
+        os.remove('constraint.tre')
+        self.generator.backend = ptools.RAxMLBackend()
+        sarg = self.generator._start(alignment, None)
+        self.assertEqual(sarg, ' -t start.tre')
+        start = Phylo.read('start.tre', 'newick')
+        os.remove('start.tre')
+        self.assertEqual(len(start.get_terminals()), len(alignment))
+
+    def test_runtime_model(self):
+        model = ptools.RuntimeModel(self.logger, multiple=10,
+                                    path='runtimes.p')
+        key = 'raxml GTRGAMMA'
+        self.assertEqual(model.predict(key, 10, 100, 1, 2), None)
+        self.assertEqual(model.deadline(key, 10, 100, 1, 2), None)
+        # slowest seconds per taxon x pattern until there are enough
+        model.add(key, 10, 100, 1, 2, 10.)
+        model.add(key, 10, 100, 1, 2, 20.)
+        self.assertAlmostEqual(model.predict(key, 20, 100, 1, 2), 40.)
+        self.assertAlmostEqual(model.deadline(key, 20, 100, 1, 2), 400.)
+        self.assertEqual(model.deadline(key, 1, 1, 1, 2), model.min_deadline)
+        # then fit seconds = taxa x patterns / threads
+        for i in range(model.min_fit):
+            ntaxa, npatterns, threads = 10 + i, 100 * (i % 3 + 1), 2 ** (i % 4)
+            model.add(key, ntaxa, npatterns, i % 2 + 1, threads,
+                      float(ntaxa * npatterns) / threads)
+        model.records[key] = model.records[key][2:]
+        model.coefficients[key] = model._fit(key)
+        self.assertAlmostEqual(model.predict(key, 50, 200, 1, 4), 2500.,
+                               places=3)
+        # a timeout below the prediction changes nothing, one above raises it
+        model.timeout(key, 50, 200, 1, 4, 60.)
+        self.assertAlmostEqual(model.predict(key, 50, 200, 1, 4), 2500.,
+                               places=3)
+        model.timeout(key, 50, 200, 1, 4, 1e5)
+        self.assertTrue(model.predict(key, 50, 200, 1, 4) > 2500.)
+        # other backends and models are timed apart
+        self.assertEqual(model.predict('nj', 50, 200, 1, 4), None)
+        model.add('nj', 50, 200, 1, 4, 0.01)
+        self.assertTrue(model.predict(key, 50, 200, 1, 4) > 2500.)
+        # past searches and timeouts are kept on disk, once saved
+        model.save()
+        model = ptools.RuntimeModel(self.logger, path='runtimes.p')
+        self.assertEqual(len(model.records[key]), model.min_fit)
+        self.assertEqual(len(model.timeouts[key]), 2)
+        self.assertEqual(len(model.records['nj']), 1)
+        # timeouts raise the rate used before the fit
+        model = ptools.RuntimeModel(self.logger, path='other_runtimes.p')
+        model.add(key, 10, 100, 1, 2, 10.)
+        model.timeout(key, 10, 100, 1, 2, 60.)
+        self.assertAlmostEqual(model.predict(key, 10, 100, 1, 2), 60.)
+        self.assertFalse(os.path.exists('other_runtimes.p'))
+
+    def test_generator_runtimes(self):
+        self.generator.runtimes = ptools.RuntimeModel(self.logger,
+                                                      path='runtimes.p')
+        self.assertTrue(self.generator.generate())
+        self.assertEqual(self.generator.runtimes.records.keys(),
+                         ['raxml GTRGAMMA'])
+        self.assertEqual(len(self.generator.runtimes.records.values()[0]), 1)
+        size = self.generator._setUp(test_alignments, [None, None])[4]
+        self.assertEqual(size[:2], ('raxml GTRGAMMA', len(test_alignment)))
+
+    def test_generator_prescreen(self):
+        alignments, frames = self.alignment_store.pull()
+        self.generator.prescreen = 1e9
+        self.assertTrue(self.generator._prescreen(alignments, frames))
+        self.generator.prescreen = 1e-9
+        self.assertFalse(self.generator._prescreen(alignments, frames))
+        # rejected draws are not searched, unless audited
+        self.generator.prescreen_audit = 0
+        self.assertEqual(self.generator.generate(), None)
+        self.assertEqual(self.generator.trys, 1)
+        self.generator.prescreen_audit = 1
+        self.assertTrue(self.generator.generate())
+        self.assertEqual(self.generator.prescreened,
+                         {'screened': 2, 'rejected': 2, 'audited': 1,
+                          'false_rejects': 1})
+
+    def test_generator_batch(self):
+        self.generator.batch = 3
+        self.generator.runtimes = ptools.RuntimeModel(self.logger,
+                                                      path='runtimes.p')
+        alignments, frames = self.alignment_store.pull()
+        res = self.generator._search(alignments, frames, 2, ntrees=3)
+        self.assertEqual(len(res), 3)
+        # batch timings are not single search timings
+        self.assertEqual(self.generator.runtimes.records, {})
+        self.generator.runtimes = None
+        # one draw for three trees
+        trys = []
+
+        def pull():
+            trys.append(1)
+            return alignments, frames
+
+        self.generator.alignment_store.pull = pull
+        for _ in range(3):
+            self.assertTrue(self.generator.generate())
+        self.assertEqual(len(trys), 1)
+        self.assertEqual(len(self.generator.phylogenies), 3)
+        # backends without batches search one at a time
+        res = ptools.NJBackend().searches(test_alignment, wd=self.wd,
+                                          logger=self.logger, threads=1,
+                                          ntrees=2)
+        self.assertEqual(len(res), 2)
+
+    def test_generator_resume(self):
+        os.mkdir('checkpoints')
+        self.generator.checkpoints = 'checkpoints'
+        alignments, frames = self.alignment_store.pull()
+        wd = self.generator._checkpoint(alignments, frames)
+        # interrupted before draw was recorded
+        os.mkdir(os.path.join('checkpoints', 'tree_empty'))
+        self.assertEqual(self.generator.resume(), 1)
+        self.assertEqual(os.listdir('checkpoints'), [os.path.basename(wd)])
+        # resumed draw is searched before new draws
+        trys = []
+
+        def pull():
+            trys.append(1)
+            return alignments, frames
+
+        self.generator.alignment_store.pull = pull
+        self.assertTrue(self.generator.generate())
+        self.assertEqual(len(trys), 0)
+        self.assertEqual(os.listdir('checkpoints'), [])
+        # new draws are checkpointed until searched
+        self.assertTrue(self.generator.generate())
+        self.assertEqual(len(trys), 1)
+        self.assertEqual(os.listdir('checkpoints'), [])
+        # not while RAxML is still running there
+        wd = self.generator._checkpoint(alignments, frames)
+        with open(os.path.join(wd, 'RAxML.pid'), 'w') as file:
+            file.write('{0}\n'.format(os.getpid()))
+        self.assertEqual(self.generator.resume(), 0)
+        process = subprocess.Popen(['true'])
+        process.wait()
+        with open(os.path.join(wd, 'RAxML.pid'), 'w') as file:
+            file.write('{0}\n'.format(process.pid))
+        self.assertEqual(self.generator.resume(), 1)
+        # only searches of the same constraint are resumed
+        self.generator.constraint = not self.generator.constraint
+        self.assertEqual(self.generator.resume(), 0)
+        shutil.rmtree(wd)
+        # only long searches are checkpointed
+        checkpoints = []
+
+        def RAxML(*args, **kwargs):
+            checkpoints.append(kwargs['checkpoint'])
+            return dummy_RAxML(*args, **kwargs)
+
+        ptools.RAxML = RAxML
+        self.generator.constraint = False
+        self.generator.runtimes = ptools.RuntimeModel(self.logger,
+                                                      path='runtimes.p')
+        for key in ('raxml GTRCAT', 'raxml GTRGAMMA'):
+            self.generator.runtimes.add(key, 1000, 1000, 1, 1, 1.)
+        self.assertTrue(self.generator.generate())
+        self.generator.checkpoint_after = 0
+        self.assertTrue(self.generator.generate())
+        self.assertEqual(checkpoints, [False, True])
+        self.generator.runtimes = None
+        # only unconstrained searches are checkpointed
+        checkpointed = []
+
+        def checkpoint(alignments, frames):
+            checkpointed.append(1)
+            return None
+
+        self.generator._checkpoint = checkpoint
+        for constraint in (True, False):
+            self.generator.constraint = constraint
+            self.assertTrue(self.generator.generate())
+        self.assertEqual(len(checkpointed), 1)
+
+    def test_resume_raxml(self):
+        os.mkdir('checkpoints')
+        for i in (0, 3, 12):
+            with open(os.path.join('checkpoints',
+                                   'RAxML_checkpoint.phylogeny_out.{0}'.
+                                   format(i)), 'w') as file:
+                file.write(str(i))
+        with open(os.path.join('checkpoints', 'RAxML_info.phylogeny_out'),
+                  'w') as file:
+            file.write('info')
+        self.assertTrue(ptools.resumeRAxML('checkpoints', 'phylogeny_out'))
+        self.assertEqual(os.listdir('checkpoints'), ['resume.tre'])
+        with open(os.path.join('checkpoints', 'resume.tre'), 'r') as file:
+            self.assertEqual(file.read(), '12')
+        self.assertFalse(ptools.resumeRAxML('checkpoints', 'phylogeny_out'))
+
+    def test_calc_searches(self):
+        self.assertEqual(ptools.calcSearches(8, 0), (1, 9))
+        self.assertEqual(ptools.calcSearches(8, 2), (4, 3))
+        self.assertEqual(ptools.calcSearches(8, 3), (2, 4))
+        self.assertEqual(ptools.calcSearches(2, 4), (1, 3))
+
+    def test_generate_phylogenies(self):
+        res = ptools.generatePhylogenies(self.generator, 5, 'distribution.tre',
+                                         3, self.logger)
+        self.assertEqual(res, 5)
+        trees = list(Phylo.parse('distribution.tre', 'newick'))
+        self.assertEqual(len(trees), 5)
+        # splits are counted as trees are written
+        counter = ptools.SplitCounter()
+        ptools.generatePhylogenies(self.generator, 2, 'distribution.tre', 1,
+                                   self.logger, counter=counter)
+        self.assertEqual(counter.ntrees, 2)
+        # stops early once trees have converged
+        res = ptools.generatePhylogenies(self.generator, 10,
+                                         'distribution.tre', 1, self.logger,
+                                         counter=counter, asdsf=0.01,
+                                         minphylos=4)
+        self.assertEqual(res, 2)
+        self.assertEqual(counter.ntrees, 4)
+
+    def test_generate_phylogenies_error(self):
+        # running searches are killed and joined when a search fails
+
+        class Generator(object):
+            pipes = None
+            searches = []
+
+            def generate(self):
+                if not self.searches:
+                    pipe = ptools.TerminationPipe('sleep 60 | cat',
+                                                  pipes=self.pipes)
+                    self.searches.append(pipe)
+                    pipe.run()
+                    return None
+                time.sleep(0.5)
+                raise ptools.RAxMLError()
+
+        generator = Generator()
+        start = time.time()
+        with self.assertRaises(ptools.RAxMLError):
+            ptools.generatePhylogenies(generator, 2, 'distribution.tre', 2,
+                                       self.logger)
+        self.assertTrue(time.time() - start < 30)
+        self.assertTrue(generator.searches[0].failure)
+        self.assertIsNotNone(generator.searches[0].process.returncode)
+
+    def test_split_counter(self):
+        counter = ptools.SplitCounter()
+        for newick in ['((A:1,B:1):1,(C:1,D:1):1);',
+                       '((A:1,B:3):1,(C:1,D:1):2);',
+                       '((A:1,C:1):1,(B:2,D:1):1);']:
+            counter.add(newick)
+        self.assertEqual(counter.ntrees, 3)
+        self.assertTrue(counter.uniform())
+        self.assertEqual(counter.commonTaxa(), ['A', 'B', 'C', 'D'])
+        self.assertEqual(counter.counts[0b0011], 2)
+        self.assertEqual(counter.counts[0b0101], 1)
+        self.assertEqual(counter.consensus(),
+                         '[&R] ((A:1.0,B:2.0)0.6667:1.0,(C:1.0,D:1.0)0.6667:'
+                         '1.5)1.0000:0.0;')
+        # halves differ by 1 tree in [AB] and [AC]
+        self.assertEqual(counter.nhalves, [2, 1])
+        self.assertAlmostEqual(counter.asdsf(), 0.5 / np.sqrt(2))
+        self.assertFalse(ptools.isConverged(counter, 0.1, 2))
+        self.assertTrue(ptools.isConverged(counter, 0.5, 2))
+        self.assertFalse(ptools.isConverged(counter, 0.5, 4))
+        # trees differing only in their taxa have converged
+        rng = random.Random(1)
+        taxa = ['t{0}'.format(i) for i in range(20)]
+        sampled = ptools.SplitCounter()
+        for _ in range(50):
+            dropped = rng.sample(taxa[1:], 3)
+            newick = taxa[0]
+            for taxon in taxa[1:]:
+                if taxon not in dropped:
+                    newick = '({0},{1})'.format(newick, taxon)
+            sampled.add(newick + ';')
+        self.assertFalse(sampled.uniform())
+        self.assertEqual(sampled.asdsf(), 0.0)
+        # with a fixed index, other tips are dropped
+        counter = ptools.SplitCounter(taxa=['A', 'B', 'C'])
+        counter.add("((A:1,'X':1):1,(B:1,C:1):1);")
+        self.assertEqual(counter.counts[0b001], 1)
+        self.assertEqual(counter.lengths[0b001], 2.0)
+        self.assertEqual(counter.common, 0b111)
+
+    def test_count_patterns(self):
+        alignment = ptools.ArrayAlignment.fromSequences(
+            ['A', 'B'], ['aacgta', 'aacgta'])
+        self.assertEqual(ptools.countPatterns(alignment), 4)
+
+    def test_alignment_store_count(self):
+        alignments, _ = self.alignment_store.pull()
+        gene, i = self.alignment_store.index[alignments[0].path]
+        self.assertEqual(self.alignment_store[gene]['counters'][i], 1)
+        self.alignment_store.count(alignments, True)
+        self.alignment_store.count(alignments, False)
+        self.assertEqual(self.alignment_store[gene]['successes'][i], 1)
+        self.assertEqual(self.alignment_store[gene]['failures'][i], 1)
+        # weighted by rate of success
+        self.alignment_store.count(alignments, True)
+        weights = self.alignment_store._weights(gene)
+        self.assertEqual(weights[i], 0.6)
+        # alignments that only fail are not drawn while others remain
+        genedata = self.alignment_store[gene]
+        genedata['successes'] = [0] * len(genedata['files'])
+        genedata['failures'] = [0] * len(genedata['files'])
+        genedata['failures'][i] = self.alignment_store.max_failures
+        # not if it only failed with the same alignments of other genes
+        genedata['partners'][i] = set([(('other', 0),)])
+        self.assertTrue(self.alignment_store._weights(gene)[i] > 0)
+        genedata['partners'][i] = set([(('other', k),) for k in
+                                       range(self.alignment_store.
+                                             max_failures)])
+        weights = self.alignment_store._weights(gene)
+        self.assertEqual(weights[i], 0)
+        j = self.alignment_store.keys().index(gene)
+        for _ in range(20):
+            self.assertNotEqual(self.alignment_store._draw()[j], i)
+        self.alignment_store.report('.')
+        with open('alignments_report.csv', 'r') as file:
+            lines = file.readlines()
+        os.remove('alignments_report.csv')
+        self.assertEqual(lines[0].strip(),
+                         'gene,alignment,used,successes,failures')
+        self.assertEqual(len(lines), 1 + sum([len(e['files']) for e in
+                                              self.alignment_store.values()]))
+
+    def test_alignment_store_restore(self):
+        self.alignment_store.restore('.')
+        alignments, _ = self.alignment_store.pull()
+        self.alignment_store.count(alignments, False)
+        self.alignment_store.save()
+        self.assertTrue(os.path.isfile('.alignment_counts.p'))
+        # counts are kept by a new store of the same alignments
+        store = ptools.AlignmentStore(clusters=['gene1_cluster0',
+                                                'gene2_cluster0'],
+                                      genedict=genedict, allrankids=[],
+                                      indir='3_alignment', logger=self.logger)
+        store.restore('.')
+        os.remove('.alignment_counts.p')
+        for key in ['counters', 'failures', 'partners']:
+            self.assertEqual([store[e][key] for e in store.keys()],
+                             [self.alignment_store[e][key] for e in
+                              store.keys()])
+
+    def test_thread_tuner(self):
+        tuner = ptools.ThreadTuner(6, self.logger, path='calibration.p')
+        self.assertEqual(tuner.candidates(), [1, 2, 4, 6])
+        # 6 searches of 1 thread beat 1 search of 6 threads
+        self.assertEqual(tuner.best({1: 10, 2: 6, 4: 4, 6: 3}), 1)
+        self.assertEqual(tuner.best({1: 10, 2: 3, 4: 2, 6: 0.5}), 6)
+        # first tune times searches, second predicts from calibration
+        counters = [list(e['counters']) for e in
+                    self.alignment_store.values()]
+        res = tuner.tune(self.generator)
+        self.assertTrue(res in tuner.candidates())
+        self.assertTrue(os.path.isfile('calibration.p'))
+        # timed trees are kept, their draw is not counted as a use
+        self.assertEqual(len(self.generator.batched), 4)
+        self.assertEqual([e['counters'] for e in
+                          self.alignment_store.values()], counters)
+        tuner = ptools.ThreadTuner(6, self.logger, path='calibration.p')
+        self.assertEqual(len(tuner.calibration), 4)
+
+        def measure(*args):
+            raise AssertionError('not predicted')
+        tuner.measure = measure
+        self.assertTrue(tuner.tune(self.generator) in tuner.candidates())
+
+    def test_neighbour_joining(self):
+        # example from Saitou and Nei (1987) as given on wikipedia
+        distances = [[0, 5, 9, 9, 8], [5, 0, 10, 10, 9], [9, 10, 0, 8, 7],
+                     [9, 10, 8, 0, 3], [8, 9, 7, 3, 0]]
+        newick = ptools.neighbourJoining('abcde', distances)
+        tree = Phylo.read(StringIO(newick), 'newick')
+        lengths = dict([(e.name, e.branch_length) for e in
+                        tree.get_terminals()])
+        self.assertEqual(lengths, {'a': 2, 'b': 3, 'c': 4, 'd': 2, 'e': 1})
+
+    def test_distance_matrix(self):
+        alignment = ptools.ArrayAlignment.fromSequences(
+            ['A', 'B', 'C'], ['aaaa', 'AA-a', 'aacc'])
+        distances = ptools.distanceMatrix(alignment)
+        self.assertEqual(distances[0, 1], 0)
+        self.assertTrue(distances[0, 2] > 0)
+        self.assertAlmostEqual(distances[0, 2], distances[2, 0])
+
+    def test_neighbour_joining_constrained(self):
+        # clades of the constraint are kept whatever the distances
+        alignment = ptools.asArray(test_alignment)
+        ids = alignment.ids
+        # nested constraint, one taxon left free
+        constraint = '(({0},{1}),({2},({3},{4},{5})),{6},({7},({8},{9})));'.\
+            format(*ids[:10])
+        clades = [set([e.name for e in c.get_terminals()]) for c in
+                  Phylo.read(StringIO(constraint), 'newick').
+                  get_nonterminals()[1:]]
+        rng = np.random.RandomState(1)
+        for _ in range(20):
+            distances = rng.rand(len(alignment), len(alignment))
+            distances = distances + distances.T
+            np.fill_diagonal(distances, 0)
+            newick = ptools.neighbourJoining(alignment.ids, distances,
+                                             constraint)
+            res = Phylo.read(StringIO(newick), 'newick')
+            self.assertEqual(len(res.get_terminals()), len(alignment))
+            splits = [set([e.name for e in c.get_terminals()]) for c in
+                      res.get_nonterminals()]
+            for clade in clades:
+                self.assertTrue(clade in splits or
+                                set(alignment.ids) - clade in splits)
+
+    def test_backends(self):
+        self.assertEqual(ptools.getBackend('NJ').name, 'nj')
+        with self.assertRaises(ValueError):
+            ptools.getBackend('not a backend')
+        # backends must implement search
+        with self.assertRaises(TypeError):
+            ptools.Backend()
+        self.assertTrue(ptools.RAxMLBackend.constrained)
+        self.assertFalse(ptools.NJBackend.constrained)
+        self.assertTrue(ptools.RAxMLBackend.batches)
+        self.assertFalse(ptools.NJBackend.timed)
+        self.assertEqual(ptools.RAxMLBackend().key(test_alignment),
+                         'raxml GTRGAMMA')
+        self.assertFalse(ptools.FastTreeBackend.batches)
+        self.assertFalse(ptools.NJBackend.batches)
+        self.assertEqual(ptools.ngPartitions(
+            'DNA, gene1codon1 = 1-300\\3\n'),
+            'GTR+G, gene1codon1 = 1-300/3\n')
+        # built-in backend needs no external programs
+        phylogeny = ptools.NJBackend().search(
+            test_alignment, wd=self.wd, logger=self.logger, threads=1,
+            outgroup=self.poutgroups[0])
+        self.assertEqual(len(phylogeny.get_terminals()), len(test_alignment))
+        self.generator.backend = ptools.NJBackend()
+        self.generator.rttstat = 10
+        self.assertTrue(self.generator.run())
+
     def test_countnphylos(self):
         filecontents = '\n' * 50
         with open('distribution.tre', 'w') as f:
@@ -270,6 +887,80 @@ class PhylogenyTestSuite(unittest.TestCase):
         ptools.consensus(outdir='.', min_freq=0.5,
                          is_rooted=True, trees_splits_encoded=False)
         self.assertTrue(os.path.isfile('consensus.tre'))
+        # taxa not in all trees are dropped
+        with open('distribution.tre', 'w') as file:
+            Phylo.write(phylogenies + [self.constraint], file, 'newick')
+        self.assertTrue(ptools.consensus(outdir='.'))
+        res = Phylo.read('consensus.tre', 'newick')
+        self.assertEqual(len(res.get_terminals()), 11)
+
+    @unittest.skipIf(dp is None, "Requires DendroPy")
+    def test_consensus_dendropy(self):
+        # bootstrap NJ trees of the real alignment, each missing some taxa,
+        #  should give the consensus DendroPy gives after pruning with Bio
+        rng = np.random.RandomState(1)
+        alignment = ptools.asArray(test_alignment)
+        outgroup = alignment.ids[0]
+        with open('distribution.tre', 'w') as file:
+            for _ in range(60):
+                rows = range(7) + [i for i in range(7, len(alignment)) if
+                                   rng.rand() > 0.1]
+                columns = rng.randint(0, alignment.get_alignment_length(),
+                                      alignment.get_alignment_length())
+                sample = ptools.ArrayAlignment(
+                    [alignment.ids[i] for i in rows],
+                    alignment.matrix[rows][:, columns])
+                phylogeny = Phylo.read(StringIO(ptools.neighbourJoining(
+                    sample.ids, ptools.distanceMatrix(sample))), 'newick')
+                phylogeny.root_with_outgroup(outgroup)
+                Phylo.write(phylogeny, file, 'newick')
+        counter = ptools.SplitCounter()
+        counter.read('distribution.tre')
+        self.assertFalse(counter.uniform())
+        self.assertTrue(ptools.consensus(outdir='.', counter=counter))
+        res = dp.Tree.get(path='consensus.tre', schema='newick',
+                          rooting='force-rooted')
+        # as consensus did with DendroPy
+        phylogenies = list(Phylo.parse('distribution.tre', 'newick'))
+        common = set.intersection(*[set([e.name for e in
+                                         p.get_terminals()]) for p in
+                                    phylogenies])
+        for phylogeny in phylogenies:
+            for tip in phylogeny.get_terminals():
+                if tip.name not in common:
+                    phylogeny.prune(tip.name)
+        handle = StringIO()
+        Phylo.write(phylogenies, handle, 'newick')
+        trees = dp.TreeList.get(data=handle.getvalue(), schema='newick',
+                                rooting='force-rooted')
+        sd = dp.SplitDistribution(taxon_namespace=trees.taxon_namespace)
+        tsum = dp.calculate.treesum.TreeSummarizer()
+        tsum.count_splits_on_trees(trees, split_distribution=sd)
+        expected = tsum.tree_from_splits(sd, min_freq=0.5)
+
+        def clades(tree):
+            found = {}
+            for node in tree.postorder_node_iter():
+                if node.is_leaf() or node.parent_node is None:
+                    continue
+                tips = frozenset([e.taxon.label for e in node.leaf_iter()])
+                found[tips] = (round(float(node.label), 4),
+                               round(node.edge.length, 4))
+            return found
+
+        self.assertEqual(clades(res), clades(expected))
+        self.assertEqual(len(res.leaf_nodes()), len(common))
+        # pruned counts are kept in step as more trees are added
+        pruned = counter.pruned
+        with open('distribution.tre', 'r') as file:
+            newicks = list(ptools.iterNewick(file))
+        for newick in newicks[:10]:
+            counter.add(newick)
+        self.assertTrue(counter.pruned is pruned)
+        fresh = ptools.SplitCounter()
+        for newick in newicks + newicks[:10]:
+            fresh.add(newick)
+        self.assertEqual(counter.consensus(), fresh.consensus())
 
 if __name__ == '__main__':
     unittest.main()
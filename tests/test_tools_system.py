@@ -11,6 +11,9 @@ import re
 import os
 import shutil
 import pickle
+import signal
+import time
+import threading
 import pglt.tools.system_tools as stools
 
 
@@ -120,6 +123,75 @@ class SystemTestSuite(unittest.TestCase):
         pipe = stools.TerminationPipe(cmd='mkdir folder1')
         pipe.run()
         self.assertTrue(os.path.isdir('folder1'))
+        # without a shell, piping to stdin
+        pipe = stools.TerminationPipe(cmd=['cat'], stdin='>seq\nACTG\n')
+        pipe.run()
+        self.assertEqual(pipe.stdout, '>seq\nACTG\n')
+        self.assertEqual(pipe.returncode, 0)
+        self.assertIsNotNone(pipe.cputime)
+        self.assertIsNotNone(pipe.maxrss)
+        # pid is kept in pidfile while the program runs
+        pipe = stools.TerminationPipe(cmd='sleep 1; cat test.pid',
+                                      pidfile='test.pid')
+        pipe.run()
+        self.assertEqual(pipe.stdout, '{0}\n'.format(pipe.process.pid))
+        self.assertFalse(os.path.exists('test.pid'))
+
+    def test_termination_pipe_timeout(self):
+        # shell and its children should all be killed on timeout
+        pipe = stools.TerminationPipe(cmd='sleep 60 | cat', timeout=1)
+        pipe.run()
+        self.assertTrue(pipe.failure)
+        self.assertTrue(pipe.walltime < 30)
+
+    def test_termination_pipe_interrupt(self):
+        # program should not outlive an interrupted run
+
+        def interrupt(signum, frame):
+            raise KeyboardInterrupt
+
+        handler = signal.signal(signal.SIGALRM, interrupt)
+        pipe = stools.TerminationPipe(cmd='sleep 60 | cat')
+        signal.alarm(1)
+        try:
+            self.assertRaises(KeyboardInterrupt, pipe.run)
+        finally:
+            signal.alarm(0)
+            signal.signal(signal.SIGALRM, handler)
+        # killed and waited on
+        self.assertIsNotNone(pipe.process.returncode)
+
+    def test_pipe_set(self):
+        # running pipes are killed together, later ones are not started
+        pipes = stools.PipeSet()
+        pipe = stools.TerminationPipe(cmd='sleep 60 | cat', pipes=pipes)
+        thread = threading.Thread(target=pipe.run)
+        thread.start()
+        while not pipes.pipes or pipe.process is None:
+            time.sleep(0.01)
+        pipes.kill()
+        thread.join()
+        self.assertTrue(pipe.failure)
+        self.assertTrue(pipe.walltime < 30)
+        self.assertEqual(pipes.pipes, set())
+        pipe = stools.TerminationPipe(cmd='mkdir folder1', pipes=pipes)
+        pipe.run()
+        self.assertTrue(pipe.failure)
+        self.assertFalse(os.path.isdir('folder1'))
+
+    def test_scratch_space(self):
+        # each scratch space should be unique and removed on exit
+        with stools.ScratchSpace(wd=os.getcwd(), use_tmpfs=False) as scratch1:
+            with stools.ScratchSpace(wd=os.getcwd()) as scratch2:
+                self.assertTrue(os.path.isdir(scratch1))
+                self.assertTrue(os.path.isdir(scratch2))
+                self.assertNotEqual(scratch1, scratch2)
+                open(os.path.join(scratch2, 'a_file'), 'w').close()
+            self.assertFalse(os.path.isdir(scratch2))
+        self.assertFalse(os.path.isdir(scratch1))
+        # too large a budget should fall back to wd
+        scratch = stools.ScratchSpace(wd=os.getcwd(), budget=1e20)
+        self.assertEqual(scratch._root(), os.getcwd())
 
 if __name__ == '__main__':
     unittest.main()